@@ -16,27 +16,33 @@ the user.
 
 """
 
-import os, sys, hashlib, urllib2, traceback, json, random
+import os, sys, hashlib, hmac, time, urllib2, traceback, json, random
 from cgi import parse_qs
 from Cookie import SimpleCookie
 from uuid import uuid4
-from datetime import datetime
+from datetime import datetime, timedelta
+import heapq, math
 
 try:
     # import lib dependencies
     from gevent import monkey; monkey.patch_socket()
+    import gevent
+    from gevent.queue import Queue
     import pymongo
     import zmq.green as zmq
-    from mongrel2 import handler
+    from mongrel2 import handler, green, template
+    from mongrel2.lru import LRU
     import bcrypt
+    from concurrent.futures import ProcessPoolExecutor
 except ImportError as e:
-    print('You must have gevent, pymongo, pyzmq, bcrypt and mongrel2 installed.')
+    print('You must have gevent, pymongo, pyzmq, bcrypt, futures and mongrel2 installed.')
     sys.exit(1)
 
 
 # import config constants and util funcs
 try:
     from config import Out, PATHS, DB_PORT, LOGIN_URL, HOME_URL, FQDN
+    from config import TOKEN_KEYS, SIGNED_SESSIONS
     from run import PAUSE_BEFORE_RESTART as LINGER
 except ImportError as e:
     raise e
@@ -55,14 +61,52 @@ CONFIG = {
 # define m2 and auth validation addresses
 M2IN = "tcp://127.0.0.1:7010"
 M2OUT = "tcp://127.0.0.1:7011"
+# a validate request is one frame per session id, and the reply has one
+# JSON frame per id in the same order, so a single id works just like a
+# batch of one
 VALIDATE = "tcp://127.0.0.1:7012"
 
+# sessions that stop being valid are published here so services can drop
+# any validation they cached
+INVALIDATE = "tcp://127.0.0.1:7013"
+
+# processes that run bcrypt, and how many hashes can be waiting on them
+# before logins get a 503
+HASH_WORKERS = 2
+HASH_QUEUE = 8
+
+# login attempts allowed per username and per client address, as a burst
+# and then a steady rate per second, and how many of each to track before
+# forgetting the least recently seen
+USER_LOGIN_BURST = 5
+USER_LOGIN_RATE = 5 / 60.0
+ADDR_LOGIN_BURST = 20
+ADDR_LOGIN_RATE = 1.0
+LOGIN_LIMIT_SIZE = 10000
+
+# only set when a proxy in front of mongrel2 sets x-forwarded-for, since
+# clients can put anything they like in it
+TRUST_FORWARDED_FOR = False
+
 
 # helpers
 
 HISTORY_FORMAT='%Y-%m-%d_%H:%M:%S:%f'
 
-cookie_template = 'session={s}; Domain=.{fqdn}; Max-Age=86400;'
+# seconds a session lasts
+SESSION_MAX_AGE = 86400
+
+# seconds between sweeps of expired sessions out of memory
+SWEEP_INTERVAL = 60
+
+# seconds between reloads of revoked tokens from Mongo
+REVOCATION_REFRESH = 10
+
+cookie_template = 'session={s}; Domain=.{fqdn}; Max-Age={max_age};'
+
+expired_cookie_template = 'session=; Domain=.{fqdn}; Max-Age=0;'
+
+LOGOUT_PATH = '/logout'
 
 error_template = '<p class="alert alert-error"><span class="icon-exclamation-sign"></span> Invalid username or password.</p>'
 
@@ -96,6 +140,346 @@ def _lscmp(a, b):
            and len(a) == len(b)
 
 
+# signed session tokens look like v1.<key id>.<user id>.<expires>.<signature>
+TOKEN_VERSION = 'v1'
+
+def sign_token(user_id, expires, keys=TOKEN_KEYS):
+    """
+    Issues a session token for user_id that's good until expires (a
+    unix timestamp), signed with the first of keys.
+    """
+    key_id, secret = keys[0]
+    payload = '.'.join((TOKEN_VERSION, key_id, str(user_id), str(int(expires))))
+    return payload + '.' + hmac.new(secret, payload, hashlib.sha256).hexdigest()
+
+
+def verify_token(token, keys=TOKEN_KEYS):
+    """
+    Returns the user id a token was issued for if it was signed with one
+    of keys and hasn't expired, otherwise None.  Needs no db or auth
+    round trip, so any service holding the keys can call it.
+    """
+    parts = token.split('.')
+    if len(parts) != 5 or parts[0] != TOKEN_VERSION:
+        return None
+
+    secret = dict(keys).get(parts[1])
+    if not secret:
+        return None
+
+    payload, signature = token.rsplit('.', 1)
+    if not _lscmp(signature, hmac.new(secret, payload, hashlib.sha256).hexdigest()):
+        return None
+
+    try:
+        if int(parts[3]) <= time.time():
+            return None
+    except ValueError:
+        return None
+
+    return parts[2]
+
+
+class RevocationList(object):
+    """
+    Signed tokens that were ended early, by logout for instance.  Each is
+    only remembered until it would have expired anyway, which keeps the
+    list as small as the number of tokens revoked in one session lifetime.
+
+    With a collection, revoke also writes the token to Mongo, where a TTL
+    index drops it at its expiry, and load/run read revocations back, so
+    they survive restarts of auth and of the services.  Auth publishes
+    each revocation on INVALIDATE too, and services add them as they
+    arrive, but PUB delivery is best effort (a service that's restarting
+    or not yet connected misses them), so services also poll the
+    collection every refresh seconds.
+    """
+
+    def __init__(self, collection=None, keys=TOKEN_KEYS, prune_interval=60,
+                 refresh=REVOCATION_REFRESH):
+        self.collection = collection
+        self.keys = keys
+        self.tokens = {}
+        self.prune_interval = prune_interval
+        self.pruned = time.time()
+        self.refresh = refresh
+
+    def ensure_indexes(self):
+        self.collection.ensure_index('token', unique=True)
+        self.collection.ensure_index('expires', expireAfterSeconds=0)
+
+    def load(self):
+        """
+        Adds every unexpired revocation in the collection.
+        """
+        for doc in self.collection.find({'expires': {'$gt': datetime.utcnow()}}):
+            self.add(str(doc['token']))
+
+    def run(self, out):
+        """
+        Reloads the collection every refresh seconds, logging failures
+        to out and carrying on.
+        """
+        while True:
+            gevent.sleep(self.refresh)
+            try:
+                self.load()
+            except Exception as e:
+                out.send('DB', json.dumps({
+                    'status': 'REVOCATIONS_LOAD_FAILED',
+                    'error': str(e)
+                }))
+
+    def add(self, token):
+        """
+        Remembers token as revoked if it's a valid signed token, ignores
+        anything else.  Returns its expiry, or None if it was ignored.
+        """
+        if not verify_token(token, self.keys):
+            return None
+
+        expires = self.tokens[token] = int(token.split('.')[3])
+
+        now = time.time()
+        if now - self.pruned > self.prune_interval:
+            self.tokens = dict((t, e) for t, e in self.tokens.items() if e > now)
+            self.pruned = now
+
+        return expires
+
+    def revoke(self, token):
+        """
+        Adds token and, with a collection, stores it there.  Raises
+        pymongo's errors if the write fails, after it's been added.
+        """
+        expires = self.add(token)
+        if expires is None or self.collection is None:
+            return
+
+        self.collection.update({'token': token},
+                               {'$set': {'expires': datetime.utcfromtimestamp(expires)}},
+                               upsert=True, safe=True)
+
+    def __contains__(self, token):
+        return token in self.tokens
+
+
+def revocations(client):
+    """
+    The collection revoked tokens are kept in, from a Mongo connection.
+    """
+    return client.auth.revoked
+
+
+class HashPoolFull(Exception):
+    pass
+
+class Hasher(object):
+    """
+    Runs gen_hexdigest in a pool of worker processes.  A bcrypt hash
+    burns tens to hundreds of milliseconds of CPU, so hashing in the
+    event loop would stall every session validation behind each login.
+    The calling greenlet waits on the result through gevent's threadpool
+    while everything else keeps running.  Once max_pending hashes are
+    queued or running, hexdigest raises HashPoolFull straight away
+    instead of letting logins pile up.
+    """
+
+    def __init__(self, workers=HASH_WORKERS, max_pending=HASH_QUEUE):
+        self.pool = ProcessPoolExecutor(workers)
+        self.max_pending = max_pending
+        self.pending = 0
+
+    def hexdigest(self, raw_password, salt=None):
+        if self.pending >= self.max_pending:
+            raise HashPoolFull()
+
+        self.pending += 1
+        try:
+            future = self.pool.submit(gen_hexdigest, raw_password, BCRYPT, salt)
+            return gevent.get_hub().threadpool.spawn(future.result).get()
+        finally:
+            self.pending -= 1
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False)
+
+
+class RateLimiter(object):
+    """
+    A token bucket per key, holding up to burst tokens and refilled at
+    rate tokens a second.  Buckets live in an LRU of at most size keys,
+    so a flood of distinct keys evicts the least recently seen instead
+    of growing memory.  An evicted key starts over with a full bucket.
+    """
+
+    def __init__(self, burst, rate, size=LOGIN_LIMIT_SIZE):
+        self.burst = burst
+        self.rate = rate
+        self.buckets = LRU(size)
+
+    def take(self, key):
+        """
+        Takes a token for key.  Returns 0 if there was one, otherwise the
+        seconds until there will be, and nothing is taken.
+        """
+        now = time.time()
+        tokens, last = self.buckets.get(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+
+        if tokens >= 1:
+            wait = 0
+            tokens -= 1
+        else:
+            wait = int(math.ceil((1 - tokens) / self.rate))
+
+        self.buckets.set(key, (tokens, now))
+
+        return wait
+
+
+def client_addr(req):
+    if TRUST_FORWARDED_FOR:
+        forwarded = req.headers.get('x-forwarded-for')
+        if forwarded:
+            return forwarded.split(',')[0].strip()
+    return req.headers.get('REMOTE_ADDR')
+
+
+class SessionStore(object):
+    """
+    Keeps every live session in memory so validating one is a dict
+    lookup rather than a Mongo query.  Sessions are loaded at startup
+    and changes are written back to Mongo in order by a background
+    greenlet (see run), so logins and logouts don't wait on the db.
+    Sessions past their expires time don't validate, and sweep drops
+    them from memory in expiry order.  Mongo's TTL index on expires
+    deletes them from the collection.
+    """
+
+    def __init__(self, collection, out):
+        self.collection = collection
+        self.out = out
+        self.sessions = {}
+        self.expiries = []
+        self.writes = Queue()
+
+    def load(self):
+        now = datetime.utcnow()
+        self.backfill(now)
+
+        for session in self.collection.find({'expires': {'$gt': now}}):
+            self._track(session)
+
+    def backfill(self, now):
+        """
+        Gives sessions from before expiry was tracked an expires time,
+        SESSION_MAX_AGE after they began, so the TTL index can reap them.
+        """
+        utc_offset = now - datetime.now()
+        for session in self.collection.find({'expires': {'$exists': False}}):
+            try:
+                began = datetime.strptime(session['began'], HISTORY_FORMAT) + utc_offset
+            except (KeyError, TypeError, ValueError):
+                began = now
+
+            self.collection.update({'_id': session['_id']}, {'$set': {
+                'expires': began + timedelta(seconds=SESSION_MAX_AGE)
+            }})
+
+    def get(self, key):
+        session = self.sessions.get(key)
+        if session and session['expires'] <= datetime.utcnow():
+            return None
+        return session
+
+    def get_many(self, keys):
+        """
+        Same as get, but for a list of keys in a single pass.
+        """
+        return [self.get(key) for key in keys]
+
+    def sweep(self):
+        """
+        Forgets sessions that have expired and returns their keys.  Only
+        looks at the ones that are due, so it's cheap to run often.
+        """
+        now = datetime.utcnow()
+        expired = []
+
+        while self.expiries and self.expiries[0][0] <= now:
+            expires, key = heapq.heappop(self.expiries)
+
+            # skip keys that were removed, or replaced by a later login
+            session = self.sessions.get(key)
+            if session and session['expires'] == expires:
+                del self.sessions[key]
+                expired.append(key)
+
+        return expired
+
+    def _track(self, session):
+        self.sessions[session['key']] = session
+        heapq.heappush(self.expiries, (session['expires'], session['key']))
+
+    def add(self, session):
+        self._track(session)
+        self.writes.put(('insert', session))
+
+    def remove(self, key):
+        self.sessions.pop(key, None)
+        self.writes.put(('remove', key))
+
+    def run(self):
+        while True:
+            op, arg = self.writes.get()
+
+            # keep retrying lost connections so writes land in the order
+            # they were made, but give up on a write mongo refuses
+            retried = False
+            while True:
+                try:
+                    if op == 'insert':
+                        self.collection.insert(arg, safe=True)
+                    else:
+                        self.collection.remove({'key': arg})
+                    break
+                except (pymongo.errors.ConnectionFailure, pymongo.errors.AutoReconnect) as e:
+                    self.out.send('DB', json.dumps({
+                        'status': 'WRITE_BEHIND_FAILED',
+                        'error': str(e)
+                    }))
+                    retried = True
+                    gevent.sleep(1)
+                except pymongo.errors.DuplicateKeyError as e:
+                    # the attempt that lost its connection got there first
+                    if not retried:
+                        self.out.send('DB', json.dumps({
+                            'status': 'WRITE_BEHIND_DROPPED',
+                            'op': op,
+                            'error': str(e)
+                        }))
+                    break
+                except Exception as e:
+                    self.out.send('DB', json.dumps({
+                        'status': 'WRITE_BEHIND_DROPPED',
+                        'op': op,
+                        'error': str(e)
+                    }))
+                    break
+
+
+def sweep(store, invalidate):
+    """
+    Drops expired sessions from the store every SWEEP_INTERVAL seconds,
+    publishing each so services forget they validated it.
+    """
+    while True:
+        gevent.sleep(SWEEP_INTERVAL)
+        for key in store.sweep():
+            invalidate.send(key)
+
+
 # startup
 
 def init():
@@ -123,32 +507,284 @@ def init():
 
     # connect to m2
     sender_id = uuid4().hex 
-    m2 = handler.Connection(sender_id, M2IN, M2OUT, LINGER)
+    m2 = green.Connection(sender_id, M2IN, M2OUT, LINGER,
+                          compressor=handler.Compressor())
 
     # bind to validate address
     validate = ctx.socket(zmq.REP)
     validate.linger = LINGER
     validate.bind(VALIDATE)
 
+    # bind to invalidate address
+    invalidate = ctx.socket(zmq.PUB)
+    invalidate.linger = LINGER
+    invalidate.bind(INVALIDATE)
+
     # define poller
     poller = zmq.Poller()
     poller.register(command, zmq.POLLIN)
     poller.register(checkup, zmq.POLLIN)
     poller.register(validate, zmq.POLLIN)
-    poller.register(m2.reqs, zmq.POLLIN)
+
+    # signed tokens logged out before they expire
+    revoked = RevocationList()
 
     # connect to mongo
     try:
-        c = connection = pymongo.Connection('localhost', DB_PORT)
+        c = connection = pymongo.Connection('localhost', DB_PORT,
+                                            use_greenlets=True)
         db = c.auth
         users = db.users
-        sessions = db.sessions
+
+        # index what logins and validations look up
+        users.ensure_index('username')
+        db.sessions.ensure_index('key', unique=True)
+
+        # have mongo delete sessions once they expire
+        db.sessions.ensure_index('expires', expireAfterSeconds=0)
+
+        # load sessions into memory
+        store = SessionStore(db.sessions, out)
+        store.load()
+        gevent.spawn(store.run)
+        gevent.spawn(sweep, store, invalidate)
+
+        # keep revoked tokens in mongo so restarting doesn't revive them
+        revoked.collection = revocations(c)
+        revoked.ensure_indexes()
+        revoked.load()
     except Exception as e:
         out.send("DB", "Couldn't connect to MongoDB.")
 
-    # cache login page template
-    with open('./login.html', 'r') as f:
-        login_template = f.read()
+    # hash passwords out of process
+    hasher = Hasher()
+
+    # throttle login attempts before they cost a hash
+    user_logins = RateLimiter(USER_LOGIN_BURST, USER_LOGIN_RATE)
+    addr_logins = RateLimiter(ADDR_LOGIN_BURST, ADDR_LOGIN_RATE)
+
+    # compile login page template, recompiled when the file changes
+    login_template = template.load('./login.html')
+
+    # each request from mongrel2 runs in its own greenlet
+    def handle(m2, req):
+
+        username, pswd = None, None
+        redirect = HOME_URL
+
+        # if a disconnect, bail
+        if req.is_disconnect(): 
+            return
+
+        # if logging out, end the session and tell services
+        if req.path == LOGOUT_PATH:
+
+            session_id = ''
+            cookie = req.headers.get('cookie')
+            if cookie:
+                s = SimpleCookie(str(cookie)).get('session')
+                if s:
+                    session_id = str(s.value)
+
+            if session_id:
+                if SIGNED_SESSIONS and verify_token(session_id):
+                    try:
+                        revoked.revoke(session_id)
+                    except (pymongo.errors.ConnectionFailure, pymongo.errors.AutoReconnect) as e:
+                        out.send('DB', json.dumps({
+                            'status': 'REVOKE_FAILED',
+                            'error': str(e)
+                        }))
+                else:
+                    store.remove(session_id)
+                invalidate.send(session_id)
+
+            out.send('LOGOUT', json.dumps({
+                'status': 'LOGGED_OUT',
+                'id': req.conn_id
+            }))
+
+            m2.reply_http(req,
+                          '',
+                          code=302,
+                          headers={
+                                'Location': LOGIN_URL,
+                                'Set-Cookie': expired_cookie_template.format(fqdn=FQDN)
+                          })
+            return
+
+        # if posting login creds
+        if req.headers.get('METHOD') == 'POST':
+
+            # parse creds
+            d = parse_qs(req.body)
+            try:
+                username, pswd = d.get('name')[0], d.get('password')[0]
+                redirect = d.get('redirect')
+                redirect = redirect[0] if len(redirect) else ''
+                if redirect:
+                    redirect = redirect.lstrip('/')
+                    redirect = urllib2.unquote(redirect)
+            except (KeyError, IndexError, TypeError) as e:
+                out.send('LOGIN', json.dumps({
+                    'status': 'BAD_POST_DATA',
+                    'error': str(e)
+                }))
+
+            out.send('LOGIN', json.dumps({
+                'status': 'LOGIN_POST',
+                'username': username,
+                'redirect': redirect,
+                'id': req.conn_id
+            }))
+
+            # too many attempts from this address or on this username
+            wait = addr_logins.take(client_addr(req))
+            if not wait and username:
+                wait = user_logins.take(username)
+            if wait:
+                out.send('LOGIN', json.dumps({
+                    'status': 'RATE_LIMITED',
+                    'username': username,
+                    'id': req.conn_id
+                }))
+                m2.reply_http(req, 'Too many login attempts, try again shortly.',
+                              code=429, status='Too Many Requests',
+                              headers={'Retry-After': wait})
+                return
+
+            # if creds were sent
+            if username and pswd:
+                user = users.find_one({'username': username})
+
+                # if user validates set session cookie and redirect
+                if user:
+                    try:
+                        algorithm, salt, encrypted_pswd = hasher.hexdigest(pswd, 
+                                                          salt=user.get('salt'))
+                    except HashPoolFull as e:
+                        out.send('LOGIN', json.dumps({
+                            'status': 'HASH_POOL_FULL',
+                            'username': username,
+                            'id': req.conn_id
+                        }))
+                        m2.reply_http(req, 'Too many logins, try again shortly.',
+                                      code=503, status='Service Unavailable',
+                                      headers={'Retry-After': 1})
+                        return
+                            
+                    if _lscmp(encrypted_pswd, user.get('pswd')):
+                        if SIGNED_SESSIONS:
+                            # stateless, any service can check it
+                            value = sign_token(user.get('_id'), 
+                                               time.time() + SESSION_MAX_AGE)
+                        else:
+                            timestamp = datetime.now().strftime(HISTORY_FORMAT)
+                            h = hashlib.sha512('{random}{time}{user}'.format(
+                                                    random=random.randint(0, 100 * 100 * 100),
+                                                    time=timestamp,
+                                                    user=user.get('_id')))
+                            value = h.hexdigest()
+
+                            store.add({
+                                'key': value,
+                                'began': timestamp, 
+                                'expires': datetime.utcnow() + timedelta(seconds=SESSION_MAX_AGE),
+                                'user_id': user.get('_id') 
+                            })
+
+                        cookie_value = cookie_template.format(s=value, 
+                                                              fqdn=FQDN,
+                                                              max_age=SESSION_MAX_AGE)
+                        m2.reply_http(req,
+                                      '',
+                                      code=302,
+                                      headers={
+                                            'Location': redirect,
+                                            'Set-Cookie': cookie_value
+                                      })
+
+                        out.send('LOGIN', json.dumps({
+                            'status': 'LOGIN_SUCCESS',
+                            'username': username,
+                            'redirect': redirect,
+                            'id': req.conn_id
+                        }))
+
+                        return
+
+            # respond with invalid login
+            out.send('LOGIN', json.dumps({
+                'status': 'INVALID_CREDS',
+                'username': username,
+                'id': req.conn_id
+
+            }))
+            response = login_template.render(
+                            title='Invalid Login',
+                            error=error_template ,
+                            redirect=redirect)
+
+            m2.reply_http(req,
+                          response,
+                          code=200,
+                          headers={
+                            'Content-Type': 'text/html'
+                          })
+            return
+
+        # else get request assumed
+        else:
+
+            code = 200
+            qs = req.headers.get('QUERY')
+
+            if qs:
+                try:
+                    # grab redirect from query string so it can be 
+                    # passed to hidden input
+                    redirect = parse_qs(qs).get('redirect')[0]
+                except (KeyError, IndexError, TypeError):
+                    redirect = ''
+
+            start_time = json.dumps(datetime.now(), default=dthandler)
+            out.send('REQUEST', json.dumps({
+                'status': 'RECEIVED',
+                'redirect': redirect,
+                'time': start_time,
+                'id': req.conn_id
+            }))
+
+            try:
+                # render page
+                response = login_template.render(title="Please Log In",
+                                                 error='',
+                                                 redirect=redirect)
+            except KeyError as e:
+                out.send('ERROR', str(e))
+                response = "Server Error: Couldn't load auth page."
+                code = 500
+
+            m2.reply_http(req,
+                          response,
+                          code=code,
+                          headers={
+                              'Content-type': 'text/html'
+                          })
+
+            end_time = json.dumps(datetime.now(), default=dthandler)
+            out.send('REQUEST', json.dumps({
+                'status': 'DELIVERED',
+                'time': end_time,
+                'id': req.conn_id
+            }))
+
+            return
+
+    # pull requests from mongrel2 into a bounded pool of greenlets, so a
+    # login waiting on bcrypt doesn't hold up session validation
+    dispatcher = green.Dispatcher(m2, handle, out=out)
+    dispatcher.start()
 
     out.send('HELLO')
 
@@ -175,12 +811,16 @@ def init():
 
                     out.send('GOODBYE')
 
+                    # let requests in flight finish, then close the m2 sockets
+                    dispatcher.close(LINGER)
+
                     # close all sockets
                     validate.close()
+                    invalidate.close()
                     command.close()
                     checkup.close()
                     output.close()
-                    m2.shutdown()
+                    hasher.shutdown()
                     ctx.term()
                     gevent.shutdown()
 
@@ -200,164 +840,23 @@ def init():
             # session validation request made
             elif validate in socks and socks[validate] == zmq.POLLIN:
 
-                # return validation outcome
-                session_id = validate.recv()
-                session = sessions.find_one({'key': session_id})
-                if session:
-                    out.send('VALIDATE', '{0} successfully validated.'.format(session_id))
-                    validate.send_json({'success': True})
-                    continue
-                out.send('VALIDATE', '{0} did not validate.'.format(session_id))
-                validate.send_json({'success': False, 'redirect': LOGIN_URL})
+                # return validation outcome, one frame per session id
+                session_ids = validate.recv_multipart()
+                results = []
+                for session_id, session in zip(session_ids, store.get_many(session_ids)):
+                    if not session and SIGNED_SESSIONS:
+                        session = verify_token(session_id) and session_id not in revoked
+                    if session:
+                        out.send('VALIDATE', '{0} successfully validated.'.format(session_id))
+                        results.append(json.dumps({'success': True}))
+                    else:
+                        out.send('VALIDATE', '{0} did not validate.'.format(session_id))
+                        results.append(json.dumps({'success': False, 'redirect': LOGIN_URL}))
+
+                validate.send_multipart(results)
                 continue
 
 
-            # push from webserver
-            elif m2.reqs in socks and socks[m2.reqs] == zmq.POLLIN:
-
-                req = m2.recv()
-
-                username, pswd = None, None
-                redirect = HOME_URL
-
-                # if a disconnect, bail
-                if req.is_disconnect(): 
-                    continue
-
-                # if posting login creds
-                if req.headers.get('METHOD') == 'POST':
-
-                    # parse creds
-                    d = parse_qs(req.body)
-                    try:
-                        username, pswd = d.get('name')[0], d.get('password')[0]
-                        redirect = d.get('redirect')
-                        redirect = redirect[0] if len(redirect) else ''
-                        if redirect:
-                            redirect = redirect.lstrip('/')
-                            redirect = urllib2.unquote(redirect)
-                    except (KeyError, IndexError, TypeError) as e:
-                        out.send('LOGIN', json.dumps({
-                            'status': 'BAD_POST_DATA',
-                            'error': str(e)
-                        }))
-
-                    out.send('LOGIN', json.dumps({
-                        'status': 'LOGIN_POST',
-                        'username': username,
-                        'redirect': redirect,
-                        'id': req.conn_id
-                    }))
-
-                    # if creds were sent
-                    if username and pswd:
-                        user = users.find_one({'username': username})
-
-                        # if user validates set session cookie and redirect
-                        if user:
-                            algorithm, salt, encrypted_pswd = gen_hexdigest(pswd, 
-                                                              salt=user.get('salt'))
-                            
-                            if _lscmp(encrypted_pswd, user.get('pswd')):
-                                timestamp = datetime.now().strftime(HISTORY_FORMAT)
-                                h = hashlib.sha512('{random}{time}{user}'.format(
-                                                        random=random.randint(0, 100 * 100 * 100),
-                                                        time=timestamp,
-                                                        user=user.get('_id')))
-                                value = h.hexdigest()
-
-                                sessions.insert({
-                                    'key': value,
-                                    'began': timestamp, 
-                                    'user_id': user.get('_id') 
-                                }, safe=True)
-
-                                cookie_value = cookie_template.format(s=value, 
-                                                                      fqdn=FQDN)
-                                m2.reply_http(req,
-                                              '',
-                                              code=302,
-                                              headers={
-                                                    'Location': redirect,
-                                                    'Set-Cookie': cookie_value
-                                              })
-
-                                out.send('LOGIN', json.dumps({
-                                    'status': 'LOGIN_SUCCESS',
-                                    'username': username,
-                                    'redirect': redirect,
-                                    'id': req.conn_id
-                                }))
-
-                                continue
-
-                    # respond with invalid login
-                    out.send('LOGIN', json.dumps({
-                        'status': 'INVALID_CREDS',
-                        'username': username,
-                        'id': req.conn_id
-
-                    }))
-                    response = login_template.format(
-                                    title='Invalid Login',
-                                    error=error_template ,
-                                    redirect=redirect)
-
-                    m2.reply_http(req,
-                                  response,
-                                  code=200,
-                                  headers={
-                                    'Content-Type': 'text/html'
-                                  })
-                    continue
-
-                # else get request assumed
-                else:
-
-                    code = 200
-                    qs = req.headers.get('QUERY')
-
-                    if qs:
-                        try:
-                            # grab redirect from query string so it can be 
-                            # passed to hidden input
-                            redirect = parse_qs(qs).get('redirect')[0]
-                        except (KeyError, IndexError, TypeError):
-                            redirect = ''
-
-                    start_time = json.dumps(datetime.now(), default=dthandler)
-                    out.send('REQUEST', json.dumps({
-                        'status': 'RECEIVED',
-                        'redirect': redirect,
-                        'time': start_time,
-                        'id': req.conn_id
-                    }))
-
-                    try:
-                        # render page
-                        response = login_template.format(title="Please Log In",
-                                                         error='',
-                                                         redirect=redirect)
-                    except KeyError as e:
-                        out.send('ERROR', str(e))
-                        response = "Server Error: Couldn't load auth page."
-                        code = 500
-
-                    m2.reply_http(req,
-                                  response,
-                                  code=code,
-                                  headers={
-                                      'Content-type': 'text/html'
-                                  })
-
-                    end_time = json.dumps(datetime.now(), default=dthandler)
-                    out.send('REQUEST', json.dumps({
-                        'status': 'DELIVERED',
-                        'time': end_time,
-                        'id': req.conn_id
-                    }))
-
-                    continue
         except Exception as e:
             out.send('\nFAIL!\n-----')
             out.send('{0}----'.format(traceback.format_exc()))
@@ -0,0 +1,102 @@
+"""
+Times mongrel2.tnetstrings.parse against the original slicing parser on
+payloads of growing size.  The old parser copies the rest of the buffer
+for every element, so its time per element grows with the payload; the
+offset based one should stay flat.
+
+    python bench_tnetstrings.py [max elements]
+"""
+
+import sys, time
+
+from mongrel2 import tnetstrings
+
+
+# the parser as it was before it walked the buffer by offset
+
+def old_parse(data):
+    payload, payload_type, remain = old_parse_payload(data)
+
+    if payload_type == '#':
+        value = int(payload)
+    elif payload_type == '}':
+        value = old_parse_dict(payload)
+    elif payload_type == ']':
+        value = old_parse_list(payload)
+    elif payload_type == '!':
+        value = payload == 'true'
+    elif payload_type == '^':
+        value = float(payload)
+    elif payload_type == '~':
+        value = None
+    else:
+        value = payload
+
+    return value, remain
+
+def old_parse_payload(data):
+    length, extra = data.split(':', 1)
+    length = int(length)
+
+    payload, extra = extra[:length], extra[length:]
+    payload_type, remain = extra[0], extra[1:]
+
+    return payload, payload_type, remain
+
+def old_parse_list(data):
+    result = []
+    while data:
+        value, data = old_parse(data)
+        result.append(value)
+
+    return result
+
+def old_parse_dict(data):
+    result = {}
+    while data:
+        key, data = old_parse(data)
+        value, data = old_parse(data)
+        result[key] = value
+
+    return result
+
+
+def payload(n):
+    # a list of header-like dicts, roughly 150 bytes each
+    return tnetstrings.dump([{
+        'host': 'www.example.com',
+        'user-agent': 'Mozilla/5.0 (X11; Linux x86_64)',
+        'content-length': i,
+        'keep-alive': True
+    } for i in xrange(n)])
+
+
+def best_of(parse, data, runs=3):
+    best = None
+    for _ in xrange(runs):
+        start = time.time()
+        parse(data)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best
+
+
+def main(max_n=16000):
+    print('%8s %10s %12s %12s %12s %12s' % ('elements', 'bytes', 'old s',
+          'old us/elt', 'new s', 'new us/elt'))
+
+    n = 500
+    while n <= max_n:
+        data = payload(n)
+        assert old_parse(data) == tnetstrings.parse(data)
+
+        old = best_of(old_parse, data)
+        new = best_of(tnetstrings.parse, data)
+        print('%8d %10d %12.4f %12.2f %12.4f %12.2f' % (n, len(data),
+              old, old / n * 1e6, new, new / n * 1e6))
+        n *= 2
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
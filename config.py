@@ -39,6 +39,14 @@ PATHS = {
 # set where to write pid file
 M2_PID_PATH = os.path.join(os.getcwd(), PATHS['RUN'], 'mongrel2.pid')
 
+# keys for signing session tokens as `id:secret` pairs separated by commas,
+# newest first.  The first one signs new tokens and all of them verify, so
+# rotate by prepending a new key and dropping the old one a day later.
+# With no keys set, sessions are plain keys checked against auth's store.
+TOKEN_KEYS = [tuple(k.split(':', 1)) for k in
+              os.environ.get('M2_TOKEN_KEYS', '').split(',') if ':' in k]
+SIGNED_SESSIONS = bool(TOKEN_KEYS)
+
 
 import logging
 from logging.handlers import RotatingFileHandler
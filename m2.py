@@ -49,6 +49,10 @@ M2_CONTROL_PORT = "ipc://{0}/run/m2.port".format(os.getcwd())
 
 HOST_PATTERN = '^\s*127.0.0.1\s+{0}\s*$'
 
+# control port requests never change, so encode them once
+STATUS_REQUEST = tnetstrings.dump(['status', {'what': 'net'}])
+TERMINATE_REQUEST = tnetstrings.dump(['terminate', {}])
+
 
 # helpers
 
@@ -180,7 +184,7 @@ def send_checkup():
     timeout.start()
 
     # send status request
-    control_port.send(tnetstrings.dump(['status', {'what': 'net'}]))
+    control_port.send(STATUS_REQUEST)
 
 
 def start(root):
@@ -254,7 +258,7 @@ def stop(signum, frame):
     stop_timeout.start()
 
     # send terminate request
-    control_port.send(tnetstrings.dump(['terminate', {}]))
+    control_port.send(TERMINATE_REQUEST)
 
 
 def main():
@@ -0,0 +1,132 @@
+# A gevent flavored handler Connection, in the spirit of pyzmq's zmq.green.
+# It has the same API as mongrel2.handler.Connection, but every socket call
+# yields to the gevent hub, so one process can work on many requests at
+# once.  Dispatcher runs each request in its own greenlet under a bounded
+# pool, so a slow auth or database call only holds up its own request.
+
+import sys
+import traceback
+
+import gevent
+from gevent.pool import Pool
+import zmq.green as zmq
+
+from mongrel2 import handler
+
+CTX = zmq.Context()
+
+# most requests in flight at once per Dispatcher, and most to read from
+# mongrel2 per wakeup
+DISPATCH_SIZE = 100
+DISPATCH_BATCH = 32
+
+# ms Dispatcher.serve waits for requests before checking if it was stopped
+DISPATCH_POLL = 500
+
+# seconds Dispatcher.serve pauses after a failed receive before trying again
+DISPATCH_BACKOFF = 0.1
+
+
+class Connection(handler.Connection):
+    """
+    Same as mongrel2.handler.Connection, but cooperative.  recv and
+    recv_many wait on the gevent hub, and send_wait backs off with
+    gevent.sleep, so other greenlets keep running while one waits.
+    """
+
+    context = CTX
+
+    def sleep(self, seconds):
+        gevent.sleep(seconds)
+
+
+class Dispatcher(object):
+    """
+    Receives requests from a Connection and calls handle(conn, req) for
+    each in its own greenlet, with at most size running at once.  When
+    the pool is full it stops reading requests, so they wait in zmq and
+    Mongrel2 rather than piling up in this process.  Queued broadcasts
+    on the Connection are pumped between bursts.
+
+    If handle raises, on_error(req, tb) is called with the formatted
+    traceback.  Without on_error it's sent to out, a config.Out, as a FAIL
+    log like the services' server loops write, or printed if there's no
+    out either.  Errors receiving requests are
+    reported the same way with req None, and serve keeps going.  A frame
+    that doesn't parse is reported with req None too and only that frame
+    is dropped; the rest of its burst is still handled.
+    """
+
+    def __init__(self, conn, handle, size=DISPATCH_SIZE,
+                 batch=DISPATCH_BATCH, on_error=None, out=None):
+        self.conn = conn
+        self.handle = handle
+        self.pool = Pool(size)
+        self.batch = batch
+        self.on_error = on_error
+        self.out = out
+        self.running = False
+
+    def serve(self):
+        """
+        Runs the receive loop in the current greenlet until stop is called.
+        """
+        self.running = True
+
+        while self.running:
+            try:
+                self.pool.wait_available()
+
+                timeout = 0 if self.conn.broadcasts else DISPATCH_POLL
+                size = min(self.batch, self.pool.free_count())
+                for req in self.conn.recv_many(size, timeout, self.bad_message):
+                    self.pool.spawn(self.run, req)
+
+                if self.conn.broadcasts:
+                    self.conn.pump()
+                    gevent.sleep(0)
+            except Exception as e:
+                if not self.running:
+                    break
+                self.report(None, traceback.format_exc())
+                gevent.sleep(DISPATCH_BACKOFF)
+
+    def start(self):
+        """
+        Runs serve in a new greenlet and returns it.
+        """
+        return gevent.spawn(self.serve)
+
+    def run(self, req):
+        try:
+            self.handle(self.conn, req)
+        except Exception as e:
+            self.report(req, traceback.format_exc())
+
+    def bad_message(self, msg, tb):
+        self.report(None, tb)
+
+    def report(self, req, tb):
+        if self.on_error:
+            self.on_error(req, tb)
+        elif self.out:
+            self.out.send('\nFAIL!\n-----')
+            self.out.send('{0}----'.format(tb))
+        else:
+            sys.stderr.write(tb)
+
+    def stop(self, timeout=None):
+        """
+        Stops receiving and waits up to timeout seconds for the
+        requests in flight to finish.
+        """
+        self.running = False
+        self.pool.join(timeout=timeout)
+
+    def close(self, linger):
+        """
+        Stops, gives the requests in flight up to linger ms to finish,
+        then shuts down the Connection.
+        """
+        self.stop(timeout=linger / 1000.0)
+        self.conn.shutdown()
@@ -1,6 +1,14 @@
 import zmq
+import sys
 import time
+import struct
+import zlib
+import hashlib
+import traceback
+from collections import deque
+from email.utils import formatdate
 from mongrel2.request import Request
+from mongrel2.lru import LRU
 try:
     import json
 except:
@@ -9,39 +17,226 @@ except:
 CTX = zmq.Context()
 
 HTTP_FORMAT = "HTTP/1.1 %(code)s %(status)s\r\n%(headers)s\r\n\r\n%(body)s"
+STATUS_LINE_FORMAT = "HTTP/1.1 %s %s\r\n"
 MAX_IDENTS = 100
+MAX_BATCH = 64
+
+# how many MAX_IDENTS chunks of queued broadcasts go out per pump
+BROADCAST_CHUNKS = 20
+
+# replies at least this big go to zmq without being copied again, under
+# it pyzmq's copying send is cheaper than tracking the buffer
+ZERO_COPY_THRESHOLD = 64 * 1024
+
+# bodies under this many bytes aren't worth compressing
+COMPRESS_MIN_SIZE = 512
+COMPRESSIBLE_TYPES = ('text/', 'application/json', 'application/javascript',
+                      'application/xml')
+
+# ms a streamed reply waits for the resp socket to drain before giving up
+STREAM_TIMEOUT = 30 * 1000
+
+STATUS_LINES = {}
+
+def status_line(code, status):
+    """
+    Returns the formatted status line for code and status, formatting
+    each distinct pair only once.
+    """
+    try:
+        return STATUS_LINES[code, status]
+    except KeyError:
+        line = STATUS_LINES[code, status] = STATUS_LINE_FORMAT % (code, status)
+        return line
+
+_date = [None, '']
+
+def http_date():
+    """
+    The current time as an HTTP Date value, formatted at most once a second.
+    """
+    now = int(time.time())
+    if now != _date[0]:
+        _date[:] = [now, formatdate(now, usegmt=True)]
+    return _date[1]
 
 def http_response(body, code, status, headers):
-    payload = {'code': code, 'status': status, 'body': body}
+    return ''.join(http_response_parts(body, code, status, headers))
+
+def http_response_parts(body, code, status, headers):
+    """
+    Same as http_response, but returns the head and body as separate
+    strings so send can join them with the reply prefix in one copy.
+    """
     headers['Content-Length'] = len(body)
-    payload['headers'] = "\r\n".join('%s: %s' % (k,v) for k,v in
-                                     headers.items())
+    head = "\r\n".join('%s: %s' % (k,v) for k,v in headers.items())
+
+    return [status_line(code, status), head, "\r\n\r\n", body]
+
+
+class ResponseTemplate(object):
+    """
+    A response whose status and headers are the same every time it's
+    sent, like a page served with fixed no-cache headers.  The status
+    line and static headers are rendered once up front, the Date header
+    once a second, which leaves only Content-Length and the body to fill
+    in per reply.
+    """
+
+    def __init__(self, code=200, status="OK", headers=None, date=True):
+        self.code = code
+        self.status = status
+        self.headers = dict(headers or {})
+        self.date = date
+        self.content_type = ''
+        for k, v in self.headers.items():
+            if k.lower() == 'content-type':
+                self.content_type = v
+        self.head = status_line(code, status) + ''.join(
+            '%s: %s\r\n' % (k, v) for k, v in self.headers.items())
+        self.dated = (None, self.head)
+
+    def render(self, body, headers=None):
+        """
+        Returns the response for body as a list of strings ready for
+        Connection.send.  Any headers given are added for this reply only.
+        """
+        head = self.head
+        if self.date:
+            now = http_date()
+            if self.dated[0] != now:
+                self.dated = (now, '%sDate: %s\r\n' % (self.head, now))
+            head = self.dated[1]
+
+        parts = [head]
+        if headers:
+            parts.extend('%s: %s\r\n' % (k, v) for k, v in headers.items())
+        parts.append('Content-Length: %d\r\n\r\n' % len(body))
+        parts.append(body)
+
+        return parts
 
-    return HTTP_FORMAT % payload
+WEBSOCKET_CONTINUATION = 0x0
+
+# largest payload sent in one frame when streaming a fragmented message
+FRAGMENT_SIZE = 64 * 1024
+
+def websocket_header(length, opcode=1, rsvd=0, fin=True):
+    """
+    Packs the header of a server to client (so unmasked) websocket frame
+    carrying length bytes of payload.
+    """
+    first = (0x80 if fin else 0) | rsvd << 4 | opcode
+    if length < 126:
+        return struct.pack('!BB', first, length)
+    elif length < 2**16:
+        return struct.pack('!BBH', first, 126, length)
+    else:
+        return struct.pack('!BBQ', first, 127, length)
 
 def websocket_response(data,opcode=1,rsvd=0):
-    header=''
-    header+=chr(0x80|opcode|rsvd<<4)
-    realLength=len(data)
-    #print 'realLength',realLength
-    if realLength < 126:
-        dummyLength=realLength
-    elif realLength < 2**16:
-        dummyLength = 126
+    return websocket_header(len(data), opcode, rsvd) + data
+
+def websocket_fragments(data, opcode=1, rsvd=0, fragment_size=FRAGMENT_SIZE):
+    """
+    Frames data as one fragmented websocket message, yielding each frame
+    as a [header, payload] list for Connection.send.  The first frame
+    carries opcode (and rsvd), the rest are continuation frames and the
+    last has FIN set.  data is either a string, which is cut into
+    fragment_size pieces, or an iterable of chunks sent as they come.
+    """
+    if isinstance(data, str):
+        # slice lazily so only the fragment being sent is copied
+        chunks = (data[i:i + fragment_size]
+                  for i in xrange(0, len(data), fragment_size))
     else:
-        dummyLength=127
-    header+=chr(dummyLength)
-    if dummyLength == 127:
-        header += chr(realLength >> 56 &0xff)
-        header += chr(realLength >> 48 &0xff)
-        header += chr(realLength >> 40 &0xff)
-        header += chr(realLength >> 32 &0xff)
-        header += chr(realLength >> 24 & 0xff)
-        header += chr(realLength >> 16 & 0xff)
-    if dummyLength == 126 or dummyLength == 127:
-        header += chr(realLength >> 8 & 0xff)
-        header += chr(realLength & 0xff)
-    return header+data
+        chunks = iter(data)
+
+    # hold one chunk back so we know which frame gets FIN
+    prev = next(chunks, '')
+    for chunk in chunks:
+        yield [websocket_header(len(prev), opcode, rsvd, fin=False), prev]
+        opcode, rsvd = WEBSOCKET_CONTINUATION, 0
+        prev = chunk
+
+    yield [websocket_header(len(prev), opcode, rsvd), prev]
+
+
+class Compressor(object):
+    """
+    Compresses HTTP response bodies with gzip or deflate, whichever the
+    request's Accept-Encoding allows, when they're big enough to bother
+    and of a text-like content type.  Compressed bodies are kept in an
+    LRU keyed by a hash of the body, so a page that goes out over and
+    over is only compressed the first time.  The LRU holds at most
+    cache_size entries and cache_bytes bytes of compressed data.
+    """
+
+    def __init__(self, min_size=COMPRESS_MIN_SIZE, level=6, cache_size=256,
+                 cache_bytes=4 * 1024 * 1024):
+        self.min_size = min_size
+        self.level = level
+        self.cache = LRU(cache_size, cache_bytes)
+
+    def negotiate(self, accept):
+        """
+        Picks gzip or deflate out of an Accept-Encoding value, or None.
+        """
+        weights = {}
+        for part in accept.split(','):
+            name, _, params = part.partition(';')
+            q = 1.0
+            params = params.strip()
+            if params.startswith('q='):
+                try:
+                    q = float(params[2:])
+                except ValueError:
+                    q = 0.0
+            weights[name.strip().lower()] = q
+
+        for encoding in ('gzip', 'deflate'):
+            if weights.get(encoding, weights.get('*', 0)) > 0:
+                return encoding
+
+        return None
+
+    def compress(self, body, encoding):
+        """
+        Returns body compressed with encoding, from the LRU if it's there.
+        """
+        key = (encoding, hashlib.sha1(body).digest())
+        value = self.cache.get(key)
+        if value is None:
+            if encoding == 'gzip':
+                z = zlib.compressobj(self.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+                value = z.compress(body) + z.flush()
+            else:
+                value = zlib.compress(body, self.level)
+
+            self.cache.set(key, value)
+
+        return value
+
+    def apply(self, req, body, content_type):
+        """
+        Returns the body to send for req along with any headers that
+        need adding, which is None when the body goes out as it is.
+        """
+        if len(body) < self.min_size:
+            return body, None
+
+        if not content_type or not content_type.startswith(COMPRESSIBLE_TYPES):
+            return body, None
+
+        encoding = self.negotiate(req.headers.get('accept-encoding') or '')
+        if not encoding:
+            return body, {'Vary': 'Accept-Encoding'}
+
+        compressed = self.compress(body, encoding)
+        if len(compressed) >= len(body):
+            return body, {'Vary': 'Accept-Encoding'}
+
+        return compressed, {'Vary': 'Accept-Encoding', 'Content-Encoding': encoding}
 
 
 class Connection(object):
@@ -54,30 +249,52 @@ class Connection(object):
     for simplicity since that'll be fairly common.
     """
 
-    def __init__(self, sender_id, sub_addr, pub_addr, linger=1000):
+    # the zmq context sockets are made from, see mongrel2.green
+    context = CTX
+
+    def __init__(self, sender_id, sub_addr, pub_addr, linger=1000, nodrop=False,
+                 compressor=None):
         """
         Your addresses should be the same as what you configured
         in the config.sqlite for Mongrel2 and are usually like 
         tcp://127.0.0.1:9998
+
+        A PUB socket silently drops messages once its high water mark is
+        reached.  Pass nodrop=True (needs libzmq 4.1) to have sends fail
+        with EAGAIN instead, which is what lets reply_stream wait for
+        Mongrel2 to catch up rather than lose chunks.  Without XPUB_NODROP
+        support it raises ValueError rather than quietly dropping.
+
+        Give it a Compressor and reply_http and reply_template will
+        compress bodies for clients that accept it.
         """
+        if nodrop and not hasattr(zmq, 'XPUB_NODROP'):
+            raise ValueError("nodrop needs XPUB_NODROP, which this "
+                             "pyzmq/libzmq doesn't have (libzmq 4.1+)")
+
         self.sender_id = sender_id
 
-        reqs = CTX.socket(zmq.PULL)
+        reqs = self.context.socket(zmq.PULL)
         reqs.connect(sub_addr)
         reqs.linger = linger
 
-        resp = CTX.socket(zmq.PUB)
+        resp = self.context.socket(zmq.PUB)
         resp.linger = linger
 
         if sender_id:
             resp.setsockopt(zmq.IDENTITY, sender_id)
 
+        if nodrop:
+            resp.setsockopt(zmq.XPUB_NODROP, 1)
+
         resp.connect(pub_addr)
 
         self.sub_addr = sub_addr
         self.pub_addr = pub_addr
         self.reqs = reqs
         self.resp = resp
+        self.broadcasts = deque()
+        self.compressor = compressor
 
 
     def recv(self):
@@ -87,6 +304,41 @@ class Connection(object):
         """
         return Request.parse(self.reqs.recv())
 
+    def recv_many(self, max_n=MAX_BATCH, timeout=None, on_error=None):
+        """
+        Receives a burst of up to max_n requests.  It waits up to timeout
+        milliseconds for the first one (forever if timeout is None),
+        then drains whatever else is already queued without blocking, so
+        a busy handler makes one poll per burst instead of one per
+        request.  Returns an empty list if nothing arrived in time.
+
+        A message that doesn't parse is skipped without losing the rest
+        of the burst, and on_error(msg, tb) is called with it and the
+        formatted traceback; by default the traceback is printed.
+        """
+        reqs = []
+
+        if not self.reqs.poll(timeout):
+            return reqs
+
+        while len(reqs) < max_n:
+            try:
+                msg = self.reqs.recv(zmq.NOBLOCK)
+            except zmq.ZMQError as e:
+                if e.errno == zmq.EAGAIN:
+                    break
+                raise
+
+            try:
+                reqs.append(Request.parse(msg))
+            except Exception as e:
+                if on_error:
+                    on_error(msg, traceback.format_exc())
+                else:
+                    traceback.print_exc()
+
+        return reqs
+
     def recv_json(self):
         """
         Same as regular recv, but assumes the body is JSON and 
@@ -106,10 +358,58 @@ class Connection(object):
     def send(self, uuid, conn_id, msg):
         """
         Raw send to the given connection ID at the given uuid, mostly used 
-        internally.
+        internally.  The msg can also be a list of strings, which get
+        joined with the address prefix in a single copy, and big frames
+        are handed to zmq without copying them again.
+        """
+        frame = self.frame(uuid, conn_id, msg)
+        self.resp.send(frame, copy=len(frame) < ZERO_COPY_THRESHOLD)
+
+
+    def frame(self, uuid, conn_id, msg):
+        """
+        Builds the Mongrel2 reply frame for msg, a string or list of strings.
+        """
+        conn_id = str(conn_id)
+        header = "%s %d:%s, " % (uuid, len(conn_id), conn_id)
+
+        if type(msg) is list:
+            return ''.join([header] + msg)
+        else:
+            return header + msg
+
+
+    def send_wait(self, uuid, conn_id, msg, timeout=STREAM_TIMEOUT):
+        """
+        Same as send, but if the resp socket is at its high water mark
+        it backs off and retries for up to timeout milliseconds (forever
+        if None) before raising the EAGAIN.  Only a nodrop Connection
+        ever reports a full socket, otherwise this is just send.
+        """
+        frame = self.frame(uuid, conn_id, msg)
+        copy = len(frame) < ZERO_COPY_THRESHOLD
+
+        deadline = None if timeout is None else time.time() + timeout / 1000.0
+        delay = 0.001
+
+        while True:
+            try:
+                return self.resp.send(frame, zmq.NOBLOCK, copy=copy)
+            except zmq.ZMQError as e:
+                if e.errno != zmq.EAGAIN:
+                    raise
+                if deadline is not None and time.time() >= deadline:
+                    raise
+
+            self.sleep(delay)
+            delay = min(delay * 2, 0.05)
+
+
+    def sleep(self, seconds):
+        """
+        How send_wait backs off, override it to yield to your event loop.
         """
-        header = "%s %d:%s," % (uuid, len(str(conn_id)), str(conn_id))
-        self.resp.send(header + ' ' + msg)
+        time.sleep(seconds)
 
 
     def reply(self, req, msg):
@@ -134,7 +434,83 @@ class Connection(object):
         any headers you've made, and encode them so that the 
         browser gets them.
         """
-        self.reply(req, http_response(body, code, status, headers or {}))
+        headers = headers or {}
+
+        if self.compressor:
+            content_type = ''
+            for k, v in headers.items():
+                if k.lower() == 'content-type':
+                    content_type = v
+            body, extra = self.compressor.apply(req, body, content_type)
+            if extra:
+                headers = dict(headers)
+                headers.update(extra)
+
+        self.reply(req, http_response_parts(body, code, status, headers))
+
+
+    def reply_stream(self, req, chunks, code=200, status="OK", headers=None,
+                     timeout=STREAM_TIMEOUT):
+        """
+        Sends an HTTP response whose body comes from chunks, any
+        iterable of strings such as a generator, using chunked transfer
+        encoding so the body never has to be in memory all at once.
+        Each chunk is sent with send_wait, so on a nodrop Connection a
+        slow client holds up the generator instead of losing data.
+
+        HTTP/1.0 clients don't understand chunked encoding, so they get
+        the raw body and the connection is closed to end it.  If chunks
+        raises partway through, the connection is closed and the error
+        re-raised.
+        """
+        headers = dict(headers or {})
+        chunked = req.headers.get('VERSION') != 'HTTP/1.0'
+        if chunked:
+            headers['Transfer-Encoding'] = 'chunked'
+        else:
+            headers['Connection'] = 'close'
+
+        head = ''.join('%s: %s\r\n' % (k, v) for k, v in headers.items())
+        self.send_wait(req.sender, req.conn_id,
+                       [status_line(code, status), head, '\r\n'], timeout)
+
+        try:
+            for chunk in chunks:
+                # an empty chunk would end the body early
+                if not chunk:
+                    continue
+
+                if chunked:
+                    chunk = ['%x\r\n' % len(chunk), chunk, '\r\n']
+                self.send_wait(req.sender, req.conn_id, chunk, timeout)
+        except Exception:
+            # the body can't be finished, so don't leave the client
+            # waiting on the rest of it
+            exc_info = sys.exc_info()
+            try:
+                self.close(req)
+            except Exception:
+                pass
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+        if chunked:
+            self.send_wait(req.sender, req.conn_id, '0\r\n\r\n', timeout)
+        else:
+            self.close(req)
+
+
+    def reply_template(self, req, template, body, headers=None):
+        """
+        Replies with a ResponseTemplate filled in with body and any
+        per-reply headers.
+        """
+        if self.compressor:
+            body, extra = self.compressor.apply(req, body, template.content_type)
+            if extra:
+                headers = dict(headers or {})
+                headers.update(extra)
+
+        self.reply(req, template.render(body, headers))
 
 
     def reply_websocket(self, req, body, opcode=1, rsvd=0):
@@ -142,17 +518,77 @@ class Connection(object):
         Basic websocket response mechanism which will take your data,
         and encode it so that the browser gets them.
         """
-        self.reply(req, websocket_response(body, opcode, rsvd))
+        self.reply(req, [websocket_header(len(body), opcode, rsvd), body])
+
+
+    def reply_websocket_stream(self, req, data, opcode=1, rsvd=0,
+                               fragment_size=FRAGMENT_SIZE):
+        """
+        Sends data, a big string or an iterable of chunks, as a fragmented
+        websocket message so it doesn't have to be framed all at once.
+        """
+        for frame in websocket_fragments(data, opcode, rsvd, fragment_size):
+            self.reply(req, frame)
 
     def deliver(self, uuid, idents, data):
         """
         This lets you send a single message to many currently
-        connected clients.  There's a MAX_IDENTS that you should
-        not exceed, so chunk your targets as needed.  Each target
-        will receive the message once by Mongrel2, but you don't have
-        to loop which cuts down on reply volume.
+        connected clients.  Mongrel2 takes at most MAX_IDENTS targets
+        per message, so idents are chunked for you and data is encoded
+        once for all the chunks.  Each target will receive the message
+        once by Mongrel2, but you don't have to loop which cuts down on
+        reply volume.
+
+        Everything goes out before this returns, so for very large
+        audiences use broadcast instead.
         """
-        self.send(uuid, ' '.join(idents), data)
+        if type(data) is list:
+            data = ''.join(data)
+
+        idents = list(idents)
+        for i in range(0, len(idents), MAX_IDENTS):
+            self.send(uuid, ' '.join(idents[i:i + MAX_IDENTS]), data)
+
+
+    def broadcast(self, uuid, idents, data):
+        """
+        Same as deliver, but only queues the message.  Its MAX_IDENTS
+        chunks go out a few at a time each time you call pump, so a
+        broadcast to tens of thousands of clients can be interleaved
+        with regular request handling instead of stalling it.  data is
+        anything send takes, like the result of http_response_parts or
+        websocket_response, and is encoded once for every chunk.
+        """
+        idents = list(idents)
+        if not idents:
+            return
+
+        if type(data) is list:
+            data = ''.join(data)
+
+        self.broadcasts.append([uuid, idents, 0, data])
+
+
+    def pump(self, max_chunks=BROADCAST_CHUNKS):
+        """
+        Sends up to max_chunks chunks of queued broadcasts, taking turns
+        between broadcasts so a huge one can't hold up the rest.  Returns
+        True if there's still more to send, in which case your loop
+        should poll without blocking and call pump again.
+        """
+        broadcasts = self.broadcasts
+        while broadcasts and max_chunks > 0:
+            job = broadcasts.popleft()
+            uuid, idents, pos, data = job
+
+            self.send(uuid, ' '.join(idents[pos:pos + MAX_IDENTS]), data)
+            max_chunks -= 1
+
+            job[2] = pos + MAX_IDENTS
+            if job[2] < len(idents):
+                broadcasts.append(job)
+
+        return bool(broadcasts)
 
 
     def deliver_json(self, uuid, idents, data):
@@ -168,7 +604,7 @@ class Connection(object):
         you can reply to multiple connected clients waiting for an HTTP 
         response from one handler.  Kinda cool.
         """
-        self.deliver(uuid, idents, http_response(body, code, status, headers or {}))
+        self.deliver(uuid, idents, http_response_parts(body, code, status, headers or {}))
 
 
     def deliver_websocket(self, uuid, idents, body, opcode=1,rsvd=0):
@@ -177,7 +613,7 @@ class Connection(object):
         you can reply to multiple connected clients waiting for a websocket
         packet from one handler.  Kinda cool.
         """
-        self.deliver(uuid, idents, websocket_response(body,opcode,rsvd))
+        self.deliver(uuid, idents, websocket_response(body, opcode, rsvd))
 
     def close(self, req):
         """
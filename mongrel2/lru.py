@@ -0,0 +1,74 @@
+from collections import OrderedDict
+
+
+class LRU(object):
+    """
+    A bounded mapping that forgets its least recently used entries.  It
+    holds at most size entries and, when max_bytes is given, at most
+    max_bytes of values as measured by sizeof.  A value bigger than
+    max_bytes on its own isn't kept at all.
+    """
+
+    def __init__(self, size, max_bytes=None, sizeof=len):
+        self.size = size
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.bytes = 0
+        self.entries = OrderedDict()
+
+    def get(self, key, default=None):
+        """
+        Returns the value for key and marks it most recently used.
+        """
+        try:
+            value = self.entries.pop(key)
+        except KeyError:
+            return default
+
+        self.entries[key] = value
+        return value
+
+    def peek(self, key, default=None):
+        """
+        Same as get, but leaves the order alone.
+        """
+        return self.entries.get(key, default)
+
+    def set(self, key, value):
+        """
+        Stores value as the most recently used entry, evicting old ones
+        to make room.  Returns False if value was too big to keep.
+        """
+        self.pop(key)
+
+        if self.max_bytes is not None:
+            n = self.sizeof(value)
+            if n > self.max_bytes:
+                return False
+            self.bytes += n
+
+        self.entries[key] = value
+
+        while len(self.entries) > self.size or (self.max_bytes is not None
+                                                and self.bytes > self.max_bytes):
+            _, old = self.entries.popitem(last=False)
+            if self.max_bytes is not None:
+                self.bytes -= self.sizeof(old)
+
+        return True
+
+    def pop(self, key, default=None):
+        try:
+            value = self.entries.pop(key)
+        except KeyError:
+            return default
+
+        if self.max_bytes is not None:
+            self.bytes -= self.sizeof(value)
+        return value
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
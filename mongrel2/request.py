@@ -6,30 +6,91 @@ except:
 from mongrel2 import tnetstrings
 
 
+# header names mongrel2 sends with nearly every request, interned so every
+# queued request shares one copy of each instead of slicing its own
+HEADER_KEYS = dict((k, intern(k)) for k in (
+    'PATH', 'METHOD', 'VERSION', 'URI', 'QUERY', 'FRAGMENT', 'PATTERN',
+    'URL_SCHEME', 'REMOTE_ADDR', 'host', 'connection', 'cookie', 'accept',
+    'accept-encoding', 'accept-language', 'accept-charset', 'cache-control',
+    'content-length', 'content-type', 'user-agent', 'referer', 'origin',
+    'upgrade', 'x-forwarded-for', 'if-modified-since', 'if-none-match',
+))
+
+
 class Request(object):
+    """
+    A request from Mongrel2.  When built with parse it keeps the raw
+    message and only decodes the headers, body and JSON data the first
+    time each one is read, so a request sitting in a queue costs little
+    more than the message itself.
+    """
 
-    def __init__(self, sender, conn_id, path, headers, body):
+    __slots__ = ('sender', 'conn_id', 'path', 'msg', 'offset',
+                 '_headers', '_body', '_data')
+
+    def __init__(self, sender, conn_id, path, headers=None, body=None,
+                 msg=None, offset=0):
         self.sender = sender
         self.path = path
         self.conn_id = conn_id
-        self.headers = headers
-        self.body = body
-        
-        if self.headers['METHOD'] == 'JSON':
-            self.data = json.loads(body)
-        else:
-            self.data = {}
+        self.msg = msg
+        self.offset = offset
+        self._headers = headers
+        self._body = body
+        self._data = None
 
     @staticmethod
     def parse(msg):
-        sender, conn_id, path, rest = msg.split(' ', 3)
-        headers, rest = tnetstrings.parse(rest)
-        body, _ = tnetstrings.parse(rest)
+        # find the addressing fields by offset so the headers and body
+        # aren't copied out of msg until somebody reads them
+        a = msg.index(' ')
+        b = msg.index(' ', a + 1)
+        c = msg.index(' ', b + 1)
+
+        return Request(intern(msg[:a]), msg[a + 1:b], msg[b + 1:c],
+                       msg=msg, offset=c + 1)
+
+    @property
+    def headers(self):
+        if self._headers is None:
+            headers, _ = tnetstrings.parse_lazy(self.msg, self.offset,
+                                                keys=HEADER_KEYS)
+            if type(headers) is str:
+                headers = json.loads(headers)
+
+            self._headers = headers
 
-        if type(headers) is str:
-            headers = json.loads(headers)
+        return self._headers
 
-        return Request(sender, conn_id, path, headers, body)
+    @headers.setter
+    def headers(self, value):
+        self._headers = value
+
+    @property
+    def body(self):
+        if self._body is None:
+            start = tnetstrings.skip(self.msg, self.offset)
+            self._body, _ = tnetstrings.parse_at(self.msg, start)
+
+        return self._body
+
+    @body.setter
+    def body(self, value):
+        self._body = value
+
+    @property
+    def data(self):
+        if self._data is None:
+            if self.headers.get('METHOD') == 'JSON':
+                self._data = json.loads(self.body)
+            else:
+                self._data = {}
+
+        return self._data
+
+    @data.setter
+    def data(self, value):
+        self._data = value
 
     def is_disconnect(self):
         if self.headers.get('METHOD') == 'JSON':
@@ -42,4 +103,3 @@ class Request(object):
             return True
         else:
             return False
-
@@ -0,0 +1,111 @@
+# Compiled str.format style templates.  A template is parsed once into
+# its literal chunks and the slots between them, so rendering is filling
+# in the slots and one join instead of re-scanning the whole source on
+# every request.  Literal chunks are interned, so a header or stylesheet
+# repeated across templates is only held in memory once.
+
+import os
+import time
+from string import Formatter
+
+# seconds a FileTemplate goes between checking its file for changes
+CHECK_INTERVAL = 1.0
+
+_formatter = Formatter()
+_loaded = {}
+
+
+class Template(object):
+    """
+    A template in str.format syntax, {{ and }} escapes included.
+    render(**values) gives the same str as source.format(**values), even
+    for unicode values, and raises KeyError the same way when a value is
+    missing.
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self.chunks = []
+        self.slots = []
+
+        literal = []
+        for text, field, spec, conversion in _formatter.parse(source):
+            literal.append(text)
+            if field is None:
+                continue
+
+            self.chunks.append(intern(''.join(literal)))
+            literal = []
+
+            self.slots.append((len(self.chunks), field, conversion, spec))
+            self.chunks.append(None)
+
+        self.chunks.append(intern(''.join(literal)))
+
+    def render(self, **values):
+        pieces = self.chunks[:]
+
+        for i, field, conversion, spec in self.slots:
+            if field in values:
+                value = values[field]
+            else:
+                value, _ = _formatter.get_field(field, (), values)
+
+            if conversion:
+                value = _formatter.convert_field(value, conversion)
+            if spec and '{' in spec:
+                spec = _formatter.vformat(spec, (), values)
+            if spec or type(value) is not str:
+                # str.format turns unicode back into str the same way
+                value = str(format(value, spec))
+
+            pieces[i] = value
+
+        return ''.join(pieces)
+
+
+class FileTemplate(object):
+    """
+    A Template loaded from path, recompiled when the file's mtime changes.
+    The file is checked at most once every check_interval seconds.  If it
+    goes missing, the last version that compiled keeps being served.
+    """
+
+    def __init__(self, path, check_interval=CHECK_INTERVAL):
+        self.path = path
+        self.check_interval = check_interval
+        self.mtime = None
+        self.checked = 0
+        self.template = None
+        self.check()
+
+    def check(self):
+        now = time.time()
+        if self.template is not None and now - self.checked < self.check_interval:
+            return
+        self.checked = now
+
+        try:
+            mtime = os.path.getmtime(self.path)
+            if mtime != self.mtime:
+                with open(self.path, 'r') as f:
+                    self.template = Template(f.read())
+                self.mtime = mtime
+        except (IOError, OSError):
+            if self.template is None:
+                raise
+
+    def render(self, **values):
+        self.check()
+        return self.template.render(**values)
+
+
+def load(path, check_interval=CHECK_INTERVAL):
+    """
+    Returns the FileTemplate for path, shared by everyone who loads it.
+    """
+    path = os.path.abspath(path)
+    if path not in _loaded:
+        _loaded[path] = FileTemplate(path, check_interval)
+
+    return _loaded[path]
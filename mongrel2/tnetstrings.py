@@ -1,19 +1,69 @@
 # Note this implementation is more strict than necessary to demonstrate
 # minimum restrictions on types allowed in dictionaries.
 
+from collections import MutableMapping, Sequence
+
+
 def dump(data):
+    return ''.join(dump_chunks(data))
+
+
+def dump_chunks(data):
+    """
+    Encodes `data` as a list of string chunks whose concatenation is the
+    tnetstring.  Every nesting level appends to the same list, so leaf
+    strings are referenced rather than copied until the caller joins the
+    chunks once or writes them out with writelines.
+    """
+    out = []
+    _dump_into(data, out)
+    return out
+
+
+def _dump_into(data, out):
+    if type(data) is str:
+        prefix = '%d:' % len(data)
+        out.append(prefix)
+        out.append(data)
+        out.append(',')
+        return len(prefix) + len(data) + 1
+    elif type(data) is dict:
+        return _dump_container(data.items(), '}', out)
+    elif type(data) is list:
+        return _dump_container(data, ']', out)
+    else:
+        chunk = _dump_scalar(data)
+        out.append(chunk)
+        return len(chunk)
+
+
+def _dump_container(items, payload_type, out):
+    # reserve a slot for the length prefix, it isn't known until the
+    # children have been written
+    i = len(out)
+    out.append(None)
+
+    size = 0
+    if payload_type == '}':
+        for k, v in items:
+            size += _dump_into(str(k), out)
+            size += _dump_into(v, out)
+    else:
+        for v in items:
+            size += _dump_into(v, out)
+
+    out[i] = '%d:' % size
+    out.append(payload_type)
+    return len(out[i]) + size + 1
+
+
+def _dump_scalar(data):
     if type(data) is long or type(data) is int:
         out = str(data)
         return '%d:%s#' % (len(out), out)
     elif type(data) is float:
         out = '%f' % data
         return '%d:%s^' % (len(out), out)
-    elif type(data) is str:
-        return '%d:' % len(data) + data + ',' 
-    elif type(data) is dict:
-        return dump_dict(data)
-    elif type(data) is list:
-        return dump_list(data)
     elif data == None:
         return '0:~'
     elif type(data) is bool:
@@ -24,92 +74,318 @@ def dump(data):
 
 
 def parse(data):
-    payload, payload_type, remain = parse_payload(data)
+    value, end = parse_at(data)
+    return value, data[end:]
+
+def parse_at(data, offset=0, end=None):
+    """
+    Parses the tnetstring starting at `offset` in `data` without copying
+    anything but the leaf values, returning the value and the offset just
+    past it.  Containers are walked in place, so nested payloads are never
+    re-sliced.
+    """
+    if end is None:
+        end = len(data)
 
-    if payload_type == '#':
-        value = int(payload)
+    start, stop, payload_type, after = _payload(data, offset, end)
+
+    if payload_type == ',':
+        value = data[start:stop]
+    elif payload_type == '#':
+        value = int(data[start:stop])
     elif payload_type == '}':
-        value = parse_dict(payload)
+        value = _parse_dict(data, start, stop)
     elif payload_type == ']':
-        value = parse_list(payload)
+        value = _parse_list(data, start, stop)
     elif payload_type == '!':
-        value = payload == 'true'
+        value = data[start:stop] == 'true'
     elif payload_type == '^':
-        value = float(payload)
+        value = float(data[start:stop])
     elif payload_type == '~':
-        assert len(payload) == 0, "Payload must be 0 length for null."
+        assert start == stop, "Payload must be 0 length for null."
         value = None
-    elif payload_type == ',':
-        value = payload
     else:
         assert False, "Invalid payload type: %r" % payload_type
 
-    return value, remain
+    return value, after
 
-def parse_payload(data):
-    assert data, "Invalid data to parse, it's empty."
-    length, extra = data.split(':', 1)
-    length = int(length)
+def _payload(data, offset, end):
+    assert offset < end, "Invalid data to parse, it's empty."
+    colon = data.find(':', offset, end)
+    assert colon != -1, "No length prefix: %r" % data[offset:offset + 10]
+    length = int(data[offset:colon])
+    assert length >= 0, "Negative length: %d" % length
 
-    payload, extra = extra[:length], extra[length:]
-    assert extra, "No payload type: %r, %r" % (payload, extra)
-    payload_type, remain = extra[0], extra[1:]
+    start = colon + 1
+    stop = start + length
+    assert stop <= end, "Data is wrong length %d vs %d" % (length, end - start)
+    assert stop < end, "No payload type: %r" % data[start:stop]
 
-    assert len(payload) == length, "Data is wrong length %d vs %d" % (length, len(payload))
-    return payload, payload_type, remain
+    return start, stop, data[stop], stop + 1
 
-def parse_list(data):
-    if len(data) == 0: return []
+def parse_payload(data):
+    start, stop, payload_type, after = _payload(data, 0, len(data))
+    return data[start:stop], payload_type, data[after:]
 
+def _parse_list(data, offset, end):
     result = []
-    value, extra = parse(data)
-    result.append(value)
-
-    while extra:
-        value, extra = parse(extra)
+    while offset < end:
+        value, offset = parse_at(data, offset, end)
         result.append(value)
 
     return result
 
+def parse_list(data):
+    return _parse_list(data, 0, len(data))
+
+def _parse_pair(data, offset, end):
+    key, offset = parse_at(data, offset, end)
+    assert offset < end, "Unbalanced dictionary store."
+    value, offset = parse_at(data, offset, end)
+
+    return key, value, offset
+
 def parse_pair(data):
-    key, extra = parse(data)
-    assert extra, "Unbalanced dictionary store."
-    value, extra = parse(extra)
+    key, value, end = _parse_pair(data, 0, len(data))
+    return key, value, data[end:]
 
-    return key, value, extra
+def _parse_dict(data, offset, end):
+    result = {}
+    while offset < end:
+        key, value, offset = _parse_pair(data, offset, end)
+        assert type(key) is str, "Keys can only be strings."
+        result[key] = value
+
+    return result
 
 def parse_dict(data):
-    if len(data) == 0: return {}
+    return _parse_dict(data, 0, len(data))
 
-    key, value, extra = parse_pair(data)
-    assert type(key) is str, "Keys can only be strings."
 
-    result = {key: value}
+def skip(data, offset=0, end=None):
+    """
+    Returns the offset just past the tnetstring at `offset` without
+    decoding any of it.
+    """
+    if end is None:
+        end = len(data)
+    return _payload(data, offset, end)[3]
 
-    while extra:
-        key, value, extra = parse_pair(extra)
-        result[key] = value
-  
-    return result
-    
 
+def parse_lazy(data, offset=0, end=None, keys=None):
+    """
+    Same as parse_at, but dicts and lists come back as LazyDict and
+    LazyList views over `data` that only decode an element the first time
+    it's read.  `keys` can map dict keys to canonical (say interned)
+    strings so common keys share memory across messages.
+    """
+    if end is None:
+        end = len(data)
 
-def dump_dict(data):
-    result = []
-    for k,v in data.items():
-        result.append(dump(str(k)))
-        result.append(dump(v))
+    start, stop, payload_type, after = _payload(data, offset, end)
+
+    if payload_type == '}':
+        return LazyDict(data, start, stop, keys), after
+    elif payload_type == ']':
+        return LazyList(data, start, stop, keys), after
+    else:
+        return parse_at(data, offset, end)
 
-    payload = ''.join(result)
-    return '%d:' % len(payload) + payload + '}'
+
+class LazyDict(MutableMapping):
+    """
+    A dict view over an encoded tnetstring dict.  Building it indexes
+    where each value starts without decoding any of them, and values are
+    decoded and kept on first access.  It isn't a dict subclass, so
+    json.dumps won't take it; pass dict(view) instead.
+    """
+
+    def __init__(self, data, offset, end, keys=None):
+        index = {}
+        while offset < end:
+            key, offset = parse_at(data, offset, end)
+            assert type(key) is str, "Keys can only be strings."
+            assert offset < end, "Unbalanced dictionary store."
+            if keys:
+                key = keys.get(key, key)
+            index[key] = offset
+            offset = skip(data, offset, end)
+
+        self._data = data
+        self._end = end
+        self._keys = keys
+        self._offsets = index
+        self._decoded = {}
+
+    def __getitem__(self, key):
+        try:
+            return self._decoded[key]
+        except KeyError:
+            offset = self._offsets[key]
+            value, _ = parse_lazy(self._data, offset, self._end, self._keys)
+            self._decoded[key] = value
+            return value
+
+    def __setitem__(self, key, value):
+        self._offsets[key] = None
+        self._decoded[key] = value
+
+    def __delitem__(self, key):
+        del self._offsets[key]
+        self._decoded.pop(key, None)
+
+    def __contains__(self, key):
+        return key in self._offsets
+
+    def __iter__(self):
+        return iter(self._offsets)
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+
+class LazyList(Sequence):
+    """
+    A read-only list view over an encoded tnetstring list, decoding each
+    element on first access.  It isn't a list subclass, so json.dumps
+    won't take it; pass list(view) instead.
+    """
+
+    def __init__(self, data, offset, end, keys=None):
+        index = []
+        while offset < end:
+            index.append(offset)
+            offset = skip(data, offset, end)
+
+        self._data = data
+        self._end = end
+        self._keys = keys
+        self._offsets = index
+        self._decoded = {}
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self._offsets)))]
+
+        try:
+            return self._decoded[i]
+        except KeyError:
+            value, _ = parse_lazy(self._data, self._offsets[i], self._end, self._keys)
+            self._decoded[i] = value
+            return value
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __eq__(self, other):
+        if not isinstance(other, Sequence):
+            return NotImplemented
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        eq = self.__eq__(other)
+        return eq if eq is NotImplemented else not eq
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+def dump_dict(data):
+    out = []
+    _dump_container(data.items(), '}', out)
+    return ''.join(out)
 
 
 def dump_list(data):
-    result = []
-    for i in data:
-        result.append(dump(i))
+    out = []
+    _dump_container(data, ']', out)
+    return ''.join(out)
+
+
+# the spec caps length prefixes at 9 digits, which also bounds how much of
+# a stream we'll hold before deciding it isn't a tnetstring at all
+MAX_LENGTH_DIGITS = 9
+MAX_SIZE = 100 * 1024 * 1024
+
+class Decoder(object):
+    """
+    A resumable tnetstrings decoder for data that arrives in pieces, like
+    captured traffic files or large upload bodies.  Hand it chunks with
+    `feed` and it returns every value those chunks completed, holding on
+    to nothing but the partial value still in flight.  Values whose
+    declared length exceeds `max_size` are rejected before any of their
+    payload is buffered.
+    """
+
+    def __init__(self, max_size=MAX_SIZE):
+        self.max_size = max_size
+        self.buf = ''
+        self.pos = 0
+        self.chunks = []
+        self.size = 0
+        self.need = 0
+
+    def feed(self, data):
+        """
+        Adds `data` to the stream and returns a list of the values it
+        finished, which is empty if it didn't finish any.
+        """
+        values = []
+
+        if data:
+            self.chunks.append(data)
+            self.size += len(data)
+
+        # only join the pending chunks once they can complete something,
+        # so a big value trickling in costs one copy instead of one per chunk
+        while self.size and self.size >= self.need:
+            if self.chunks:
+                self.buf = self.buf[self.pos:] + ''.join(self.chunks)
+                self.pos = 0
+                self.chunks = []
+
+            if not self.need:
+                colon = self.buf.find(':', self.pos,
+                                      self.pos + MAX_LENGTH_DIGITS + 1)
+                if colon == -1:
+                    assert self.size <= MAX_LENGTH_DIGITS, \
+                        "No length prefix: %r" % self.buf[self.pos:self.pos + 10]
+                    break
+
+                length = int(self.buf[self.pos:colon])
+                assert 0 <= length <= self.max_size, \
+                    "Payload length %d is over the %d limit." % (length, self.max_size)
+
+                self.need = colon - self.pos + length + 2
+                continue
+
+            end = self.pos + self.need
+            value, after = parse_at(self.buf, self.pos, end)
+            assert after == end, "Data is wrong length %d vs %d" % (after, end)
+            values.append(value)
+
+            self.pos = end
+            self.size -= self.need
+            self.need = 0
+
+        if not self.size:
+            self.buf = ''
+            self.pos = 0
+
+        return values
 
-    payload = ''.join(result)
-    return '%d:' % len(payload) + payload + ']'
 
+def iterparse(chunks, max_size=MAX_SIZE):
+    """
+    Yields each value decoded from an iterable of string chunks, such as
+    iter(lambda: f.read(65536), '') for a file of captured messages.
+    """
+    decoder = Decoder(max_size)
+    for chunk in chunks:
+        for value in decoder.feed(chunk):
+            yield value
 
+    assert not decoder.size, "Stream ended inside a value, %d bytes left." % decoder.size
@@ -39,7 +39,7 @@ to their purposes. Monitoring processes can be written to trigger based on defin
 log sequences and begin a repair cycle.
 
 All other ZMQ channels will be app specific. This example accepts requests
-from Mongrel2 and authenticates with an auth service over a REQ/REP socket, 
+from Mongrel2 and authenticates with an auth service over a DEALER/REP socket, 
 redirecting to the login url returned by the auth service if not authenticated.
 
 My first instinct is to abstract with a delegate controller approach 
@@ -76,9 +76,11 @@ import traceback, urllib, urllib2, Cookie
 try:
     # import lib dependencies
     from gevent import monkey; monkey.patch_socket()
+    import gevent
     import pymongo
     import zmq.green as zmq
-    from mongrel2 import handler
+    from mongrel2 import handler, green, template
+    from support import AuthClient, SessionCache, MessageIndex, PageCache
 except ImportError as e:
     print('You must have gevent, pymongo, pyzmq, and mongrel2 installed.')
     sys.exit(1)
@@ -91,8 +93,9 @@ except ImportError as e:
     sys.exit(1)
 
 try:
-    # import auth req address
-    from auth import VALIDATE as AUTH
+    # import auth req and invalidation addresses
+    from auth import VALIDATE as AUTH, INVALIDATE as AUTH_INVALIDATE
+    from auth import verify_token, RevocationList, revocations, SIGNED_SESSIONS
 except ImportError as e:
     print(e)
     print("Make sure you have auth.py installed.")
@@ -117,11 +120,29 @@ CONFIG = {
 M2IN = 'tcp://127.0.0.1:7002'
 M2OUT = 'tcp://127.0.0.1:7003'
 
+# ms to wait for auth to validate a session
+AUTH_TIMEOUT = 100
+
+# seconds between checks for changes to the messages collection
+MESSAGE_REFRESH = 5
+
+# seconds a rendered page is fresh, then how much longer it can be served
+# stale while a fresh copy renders, and how much to keep at most
+PAGE_TTL = 1
+PAGE_STALE = 30
+PAGE_CACHE_SIZE = 1000
+PAGE_CACHE_BYTES = 8 * 1024 * 1024
+
+# seconds a validation is trusted without asking auth again, and how many
+# sessions to remember at most
+SESSION_TTL = 30
+SESSION_CACHE_SIZE = 10000
+
 
 
 # helpers
 
-markup = '''
+markup = template.Template('''
 <html>
     <head>
         <title>Hello {msg}</title>
@@ -130,7 +151,18 @@ markup = '''
         <p style="text-align: center; margin-top: 150px; font-family: Helvetica;">Hello {msg}.</p>
     </body>
 </html>
-'''
+''')
+
+# pages go out with the same no cache headers every time, so render them once
+nocache_headers = {
+    'Content-Type': 'text/html',
+    "Cache-Control": "no-cache, must-revalidate",
+    "Pragma": "no-cache",
+    "Expires": "Sat, 26 Jul 1997 05:00:00 GMT"
+}
+page_response = handler.ResponseTemplate(headers=nocache_headers)
+db_error_response = handler.ResponseTemplate(500, 'Internal Server Error',
+                                             headers=nocache_headers)
 
 def parse_request(req):
     time = json.dumps(datetime.datetime.now(), default=dthandler)
@@ -172,14 +204,19 @@ def init():
     out = Out(output, **CONFIG)
 
     # connect to auth
-    auth = ctx.socket(zmq.REQ)
-    auth.linger = LINGER
-    auth.hwm = 1
-    auth.connect(AUTH)
+    auth = AuthClient(ctx, AUTH, AUTH_TIMEOUT, LINGER, out)
+    validated = SessionCache(SESSION_TTL, SESSION_CACHE_SIZE)
+
+    # sub to auth's session invalidations
+    invalidations = ctx.socket(zmq.SUB)
+    invalidations.linger = LINGER
+    invalidations.setsockopt(zmq.SUBSCRIBE, '')
+    invalidations.connect(AUTH_INVALIDATE)
 
     # connect to m2
     sender_id = uuid.uuid4().hex 
-    m2 = handler.Connection(sender_id, M2IN, M2OUT)
+    m2 = green.Connection(sender_id, M2IN, M2OUT,
+                          compressor=handler.Compressor())
 
     # make mongo connection
     db = None
@@ -191,11 +228,146 @@ def init():
             'msg': "Couldn't connect to Mongo at startup."
         }))
 
+    # signed tokens auth revoked, loaded from mongo and kept current from
+    # auth's invalidations, with a poll in case one of those was missed
+    revoked = RevocationList()
+    if db is not None:
+        revoked.collection = revocations(db.connection)
+        try:
+            revoked.load()
+        except Exception as e:
+            out.send('DB', json.dumps({
+                'status': 'DOWN_CONN',
+                'msg': "Couldn't load revoked sessions."
+            }))
+        gevent.spawn(revoked.run, out)
+
+    # keep messages in memory, reloading them in the background
+    messages = MessageIndex(db, out, MESSAGE_REFRESH)
+    gevent.spawn(messages.run)
+
+    # cache rendered pages so hot ones skip the app logic
+    pages = PageCache(PAGE_TTL, PAGE_STALE, PAGE_CACHE_SIZE, PAGE_CACHE_BYTES)
+
+    def render_hello():
+        if not messages.loaded:
+            return None
+
+        # grab a random message from the index
+        text = messages.random()
+
+        # insert data into markup template
+        if text:
+            return markup.render(msg=text)
+        else:
+            return markup.render(msg='Nobody')
+
+    # each request from mongrel2 runs in its own greenlet
+    def handle(m2, req):
+
+        # if a disconnect, bail
+        if req.is_disconnect(): 
+            return
+
+        # log request
+        out.send('REQUEST', parse_request(req))
+
+        # get session from cookie
+        session = ''
+        cookie = req.headers.get('cookie')
+        if cookie:
+            c = Cookie.SimpleCookie(str(cookie))
+            s = c.get('session')
+            if s:
+                session = str(s.value)
+
+        # signed tokens check out locally, anything else goes to auth
+        resp = None
+        if SIGNED_SESSIONS and session not in revoked and verify_token(session):
+            resp = {'success': True}
+
+        # ask auth about the session, unless it answered recently
+        if resp is None:
+            resp = validated.get(session)
+        if resp is None:
+            try:
+                resp = auth.validate(session)
+            except zmq.ZMQError as e:
+                out.send('ERROR', 'Auth service queue is full.')
+
+                # auth service is down, so 500
+                m2.reply_http(req, 'Auth service not responding', code=500)
+                return
+
+            if resp is None:
+                out.send('ERROR', 'Auth timed out.')
+
+                # auth service is down, so 500
+                m2.reply_http(req, 'Auth service not responding', code=500)
+                return
+
+            validated.set(session, resp)
+
+        # if we're authed, serve
+        if resp.get('success'):
+
+            ###########################
+            ## Now do some app logic ##
+            ###########################
+
+            # only authed users get here and they all see the same page, so
+            # cache it by path, rendering it if there's no copy
+            m = pages.get(req.path, render_hello)
+
+            # if messages never loaded, this request can't happen, so 500
+            if m is None:
+                m2.reply_template(req, db_error_response, 'DB connection lost.')
+                return
+
+            # reply with no cache headers
+            m2.reply_template(req, page_response, m)
+
+            # log end of request
+            end_time = json.dumps(datetime.datetime.now(), default=dthandler)
+            out.send('REQUEST', json.dumps({
+                'status': 'DELIVERED',
+                'path': req.path,
+                'time': end_time,
+                'id': req.conn_id
+            }))
+
+
+            ###########################
+            ## app logic is complete ##
+            ###########################
+
+        # otherwise we do the auth redirect
+        else:
+            auth_url = resp.get('redirect')
+            path = URL_TEMPLATE.rstrip('/').format(req.headers.get('host') 
+                                                 + req.headers.get('URI'))
+
+            # TODO: handle auth url that includes qs's and hashes
+            path = urllib.quote(path)
+            redirect = str(auth_url + '?redirect=' + path)
+
+            m2.reply_http(req,
+                          '',
+                          code=302,
+                          headers={
+                                'Location': redirect
+                          })
+
+    # pull requests from mongrel2 into a bounded pool of greenlets, which
+    # stops reading once it's full so backpressure reaches mongrel2
+    dispatcher = green.Dispatcher(m2, handle, out=out)
+    dispatcher.start()
+
     # define poller
     poller = zmq.Poller()
     poller.register(command, zmq.POLLIN)
     poller.register(checkup, zmq.POLLIN)
-    poller.register(m2.reqs, zmq.POLLIN)
+    poller.register(invalidations, zmq.POLLIN)
 
     out.send('HELLO')
 
@@ -223,12 +395,16 @@ def init():
                 if msg.get('command') == 'die':
 
                     out.send('GOODBYE')
+
+                    # let requests in flight finish, then close the m2 sockets
+                    dispatcher.close(LINGER)
                     
                     # clean up sockets
                     command.close()
                     checkup.close()
                     output.close()
-                    m2.shutdown()
+                    auth.close()
+                    invalidations.close()
                     ctx.term()
                     gevent.shutdown()
 
@@ -242,139 +418,11 @@ def init():
                 msg = checkup.recv()
                 checkup.send("yep.")
 
-            # if mongrel2 PUSHes a request
-            elif m2.reqs in socks and socks[m2.reqs] == zmq.POLLIN:
-
-                # handle request
-                req = m2.recv()
-
-                # if a disconnect, bail
-                if req.is_disconnect(): 
-                    continue
-
-                # log request
-                out.send('REQUEST', parse_request(req))
-
-                # get session from cookie
-                session = ''
-                cookie = req.headers.get('cookie')
-                if cookie:
-                    c = Cookie.SimpleCookie(str(cookie))
-                    s = c.get('session')
-                    if s:
-                        session = str(s.value)
-
-                # send auth req
-                try:
-                    auth.send(session)
-                except zmq.ZMQError as e:
-                    out.send('ERROR', 'Auth service req/rep in wrong state.')
-
-                    # reset state by closing and reconnecting
-                    auth.close()
-                    auth = ctx.socket(zmq.REQ)
-                    auth.linger = LINGER
-                    auth.hwm = 1
-                    auth.connect(AUTH)
-
-                    # auth service is down, so 500
-                    m2.reply_http(req, 'Auth service not responding', code=500)
-                    continue
-
-                # poll with timeout for response
-                auth_poller = zmq.Poller()
-                auth_poller.register(auth, zmq.POLLIN)
-                evts = auth_poller.poll(100)
-
-                # if auth service has responded
-                if evts:
-                    resp = auth.recv_json()
-
-                    # if we're authed, serve
-                    if resp.get('success'):
-
-                        ###########################
-                        ## Now do some app logic ##
-                        ###########################
-
-                        # grab a random message from mongo
-                        try:
-                            c = db.messages.count()
-                            r = list(db.messages.find())[random.randrange(0, c)]
-                        except (pymongo.errors.ConnectionFailure, pymongo.errors.AutoReconnect) as e:
-                            # this request can't happen, so 500
-                            out.send('DB', json.dumps({
-                                'status': 'LOST_CONN',
-                                'error': str(e)
-                            }))
-                            m2.reply_http(req, 'DB connection lost.', code=500, headers={
-                                'Content-Type': 'text/html',
-                                "Cache-Control": "no-cache, must-revalidate",
-                                "Pragma": "no-cache",
-                                "Expires": "Sat, 26 Jul 1997 05:00:00 GMT"
-                            })
-                            continue
-
-
-                        # insert data into markup template
-                        if r.get('text'):
-                            m = markup.format(msg=r.get('text'))
-                        else:
-                            m = markup.format(msg='Nobody')
-
-                        # reply with no cache headers
-                        m2.reply_http(req, m, headers={
-                            'Content-Type': 'text/html',
-                            "Cache-Control": "no-cache, must-revalidate",
-                            "Pragma": "no-cache",
-                            "Expires": "Sat, 26 Jul 1997 05:00:00 GMT"
-                        })
-
-                        # log end of request
-                        end_time = json.dumps(datetime.datetime.now(), default=dthandler)
-                        out.send('REQUEST', json.dumps({
-                            'status': 'DELIVERED',
-                            'path': req.path,
-                            'time': end_time,
-                            'id': req.conn_id
-                        }))
-
-
-                        ###########################
-                        ## app logic is complete ##
-                        ###########################
-
-                    # otherwise we do the auth redirect
-                    else:
-                        auth_url = resp.get('redirect')
-                        path = URL_TEMPLATE.rstrip('/').format(req.headers.get('host') 
-                                                             + req.headers.get('URI'))
-
-                        # TODO: handle auth url that includes qs's and hashes
-                        path = urllib.quote(path)
-                        redirect = str(auth_url + '?redirect=' + path)
-
-                        m2.reply_http(req,
-                                      '',
-                                      code=302,
-                                      headers={
-                                            'Location': redirect
-                                      })
-                else:
-                    # reset state by closing and reconnecting
-                    out.send('ERROR', 'Auth timed out.')
-                    auth.close()
-                    auth = ctx.socket(zmq.REQ)
-                    auth.linger = LINGER
-                    auth.hwm = 1
-                    auth.connect(AUTH)
-
-                    # auth service is down, so 500
-                    m2.reply_http(req, 'Auth service not responding', code=500)
-                    continue
-
-                # an unexpected error if we get here, respond 500
-                m2.reply_http(req, 'Server Error', code=500)
+            # if auth says a session ended, forget we validated it
+            if invalidations in socks and socks[invalidations] == zmq.POLLIN:
+                key = invalidations.recv()
+                validated.invalidate(key)
+                revoked.add(key)
 
 
         # keep server up by catching all exceptions raised from inside server loop
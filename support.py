@@ -0,0 +1,235 @@
+"""
+Building blocks for service.py, kept out of it so that file can stay a
+flat, readable walk through a service's sockets and request handling.
+"""
+
+import time, random, json, itertools
+
+import gevent
+from gevent.event import AsyncResult
+import pymongo
+import zmq.green as zmq
+
+from mongrel2.lru import LRU
+
+# seconds AuthClient.validate waits past its timeout before giving up on
+# flush, and how long its receiver pauses after a bad reply or error
+VALIDATE_GRACE = 0.05
+RECEIVE_BACKOFF = 0.01
+
+
+class AuthClient(object):
+    """
+    Validates sessions with the auth service over a DEALER socket, so
+    any number of validations can be in flight at once.  Validations
+    asked for in the same tick of the event loop, like a burst of
+    requests from mongrel2, go out together as one batch message.  Each
+    batch is tagged with a correlation id in its envelope, which auth's
+    REP socket echoes back, and a receiver greenlet hands every reply to
+    the batch waiting on that id.  A batch that times out simply stops
+    waiting and its late reply is dropped, so one slow answer never
+    means tearing down the socket.
+    """
+
+    def __init__(self, ctx, addr, timeout, linger, out):
+        self.timeout = timeout
+        self.out = out
+        self.pending = {}
+        self.batch = []
+        self.ids = itertools.count()
+
+        self.sock = ctx.socket(zmq.DEALER)
+        self.sock.linger = linger
+        self.sock.connect(addr)
+
+        self.receiver = gevent.spawn(self.receive)
+
+    def receive(self):
+        while True:
+            try:
+                frames = self.sock.recv_multipart()
+
+                # frames are [id, '', reply, reply, ...]
+                if len(frames) < 2 or frames[1] != '':
+                    raise ValueError('Malformed auth reply: %r' % frames[:2])
+
+                result = self.pending.pop(frames[0], None)
+                if result is not None:
+                    result.set(frames[2:])
+            except Exception as e:
+                # whoever was waiting times out; keep serving the rest
+                self.out.send('ERROR', json.dumps({
+                    'status': 'AUTH_RECEIVE_FAILED',
+                    'error': str(e)
+                }))
+                gevent.sleep(RECEIVE_BACKOFF)
+
+    def validate(self, session):
+        """
+        Returns auth's reply for session, or None if it timed out.
+        Raises ZMQError if the request can't be queued.
+        """
+        result = AsyncResult()
+        self.batch.append((session, result))
+
+        # the first validation of this tick schedules the send
+        if len(self.batch) == 1:
+            gevent.spawn(self.flush)
+
+        # flush answers within timeout, the grace only covers it failing
+        try:
+            return result.get(timeout=self.timeout / 1000.0 + VALIDATE_GRACE)
+        except gevent.Timeout:
+            return None
+
+    def flush(self):
+        batch, self.batch = self.batch, []
+
+        id = str(next(self.ids))
+        replies = self.pending[id] = AsyncResult()
+
+        try:
+            self.sock.send_multipart([id, ''] + [session for session, result in batch],
+                                     zmq.NOBLOCK)
+            resps = [json.loads(r) for r in replies.get(timeout=self.timeout / 1000.0)]
+        except (gevent.Timeout, ValueError):
+            resps = []
+        except zmq.ZMQError as e:
+            for session, result in batch:
+                result.set_exception(e)
+            return
+        finally:
+            self.pending.pop(id, None)
+
+        # anything auth didn't answer counts as timed out
+        resps += [None] * (len(batch) - len(resps))
+        for (session, result), resp in zip(batch, resps):
+            result.set(resp)
+
+    def close(self):
+        self.receiver.kill()
+        self.sock.close()
+
+
+class SessionCache(object):
+    """
+    Remembers auth's answer for recently validated sessions, so repeat
+    page views skip the round trip.  Answers are trusted for ttl seconds
+    and at most size sessions are kept, least recently used going first.
+    Auth publishes sessions that end early (logout, expiry) and those
+    are dropped as they arrive; the ttl bounds how stale an answer can
+    get if one of those messages is missed.
+    """
+
+    def __init__(self, ttl, size):
+        self.ttl = ttl
+        self.entries = LRU(size)
+
+    def get(self, session):
+        entry = self.entries.get(session)
+        if entry is None or entry[0] < time.time():
+            return None
+
+        return entry[1]
+
+    def set(self, session, resp):
+        self.entries.set(session, (time.time() + self.ttl, resp))
+
+    def invalidate(self, session):
+        self.entries.pop(session)
+
+
+class MessageIndex(object):
+    """
+    Holds the text of every message in memory so a random one can be
+    picked in constant time.  run checks the collection every interval
+    seconds and reloads it when its count or newest _id changed, so
+    request latency doesn't grow with the collection.  Edits to existing
+    messages aren't noticed until something is added or removed.
+    """
+
+    def __init__(self, db, out, interval):
+        self.db = db
+        self.out = out
+        self.interval = interval
+        self.texts = []
+        self.signature = None
+
+    @property
+    def loaded(self):
+        return self.signature is not None
+
+    def refresh(self):
+        messages = self.db.messages
+        newest = messages.find_one({}, {'_id': True}, sort=[('_id', -1)])
+        signature = (messages.count(), newest and newest['_id'])
+
+        if signature != self.signature:
+            self.texts = [m.get('text') for m in messages.find({}, {'text': True})]
+            self.signature = signature
+
+    def run(self):
+        # with no db from startup there's nothing to load
+        while self.db is not None:
+            try:
+                self.refresh()
+            except (pymongo.errors.ConnectionFailure, pymongo.errors.AutoReconnect) as e:
+                self.out.send('DB', json.dumps({
+                    'status': 'LOST_CONN',
+                    'error': str(e)
+                }))
+
+            gevent.sleep(self.interval)
+
+    def random(self):
+        return random.choice(self.texts) if self.texts else None
+
+
+class PageCache(object):
+    """
+    A micro-cache for rendered pages, keyed by whatever tells them apart,
+    like the path.  It's only for pages that are the same for everyone
+    who gets them.  A page is fresh for ttl seconds.  For stale seconds
+    after that it's still served as is while a single background greenlet
+    renders its replacement, so hot pages never wait on the db or
+    template.  At most size pages and max_bytes of page data are kept,
+    least recently used going first.
+    """
+
+    def __init__(self, ttl, stale, size, max_bytes):
+        self.ttl = ttl
+        self.stale = stale
+        self.entries = LRU(size, max_bytes, sizeof=lambda entry: len(entry[2]))
+        self.refreshing = set()
+
+    def get(self, key, render):
+        """
+        Returns the page for key, calling render() for it if there's no
+        usable copy.  Pages render returns None for aren't cached.
+        """
+        now = time.time()
+        entry = self.entries.get(key)
+
+        if entry is None or entry[1] <= now:
+            return self.set(key, render())
+
+        if entry[0] <= now and key not in self.refreshing:
+            self.refreshing.add(key)
+            gevent.spawn(self.revalidate, key, render)
+
+        return entry[2]
+
+    def revalidate(self, key, render):
+        try:
+            self.set(key, render())
+        finally:
+            self.refreshing.discard(key)
+
+    def set(self, key, page):
+        if page is None:
+            self.entries.pop(key)
+            return page
+
+        now = time.time()
+        self.entries.set(key, (now + self.ttl, now + self.ttl + self.stale, page))
+        return page
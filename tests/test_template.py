@@ -0,0 +1,43 @@
+import os
+import unittest
+
+from mongrel2.template import Template
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class TemplateTest(unittest.TestCase):
+
+    def assertRendersLikeFormat(self, source, **values):
+        expected = source.format(**values)
+        rendered = Template(source).render(**values)
+        self.assertIs(type(rendered), type(expected))
+        self.assertEqual(rendered, expected)
+
+    def test_unicode_values_render_to_str(self):
+        self.assertRendersLikeFormat('<p>Hello {msg}.</p>', msg=u'world')
+        self.assertRendersLikeFormat('{a}{b!r:>8}', a=u'x', b=u'y')
+
+    def test_non_ascii_unicode_fails_like_format(self):
+        source = 'Hello {msg}'
+        self.assertRaises(UnicodeEncodeError, source.format, msg=u'w\xf6rld')
+        self.assertRaises(UnicodeEncodeError, Template(source).render,
+                          msg=u'w\xf6rld')
+
+    def test_fields_specs_and_escapes(self):
+        self.assertRendersLikeFormat('{{ {a!r:>6} }}|{b[0]}|{c.real}|{d:{w}}',
+                                     a='x', b=[1], c=3, d=4, w=5)
+
+    def test_missing_value_raises_key_error(self):
+        self.assertRaises(KeyError, Template('{title}').render)
+
+    def test_login_page(self):
+        with open(os.path.join(ROOT, 'login.html')) as f:
+            source = f.read()
+
+        self.assertRendersLikeFormat(source, title=u'Please Log In', error='',
+                                     redirect='http://example.com/')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+import time
+import unittest
+
+try:
+    import auth
+except (ImportError, SystemExit):
+    # auth.py exits when gevent, pymongo, pyzmq or bcrypt are missing
+    auth = None
+
+KEYS = [('k2', 'new secret'), ('k1', 'old secret')]
+
+
+@unittest.skipIf(auth is None, 'auth.py dependencies are not installed')
+class VerifyTokenTest(unittest.TestCase):
+
+    def token(self, user_id='u1', ttl=60, keys=KEYS):
+        return auth.sign_token(user_id, time.time() + ttl, keys)
+
+    def test_valid_token_gives_user_id(self):
+        self.assertEqual(auth.verify_token(self.token(), KEYS), 'u1')
+
+    def test_bad_signature(self):
+        token = self.token()
+        forged = token[:-1] + ('0' if token[-1] != '0' else '1')
+        self.assertIsNone(auth.verify_token(forged, KEYS))
+
+    def test_changed_payload(self):
+        token = self.token().replace('.u1.', '.u2.')
+        self.assertIsNone(auth.verify_token(token, KEYS))
+
+    def test_unknown_key_id(self):
+        token = self.token(keys=[('k9', 'new secret')])
+        self.assertIsNone(auth.verify_token(token, KEYS))
+
+    def test_expired(self):
+        self.assertIsNone(auth.verify_token(self.token(ttl=-1), KEYS))
+
+    def test_older_key_still_verifies(self):
+        token = self.token(keys=[('k1', 'old secret')])
+        self.assertEqual(auth.verify_token(token, KEYS), 'u1')
+
+    def test_rotated_out_key(self):
+        token = self.token(keys=[('k1', 'old secret')])
+        self.assertIsNone(auth.verify_token(token, [('k2', 'new secret')]))
+
+    def test_malformed(self):
+        for token in ('', 'junk', 'v1.k2.u1', 'v0' + self.token()[2:]):
+            self.assertIsNone(auth.verify_token(token, KEYS))
+
+
+@unittest.skipIf(auth is None, 'auth.py dependencies are not installed')
+class RevocationListTest(unittest.TestCase):
+
+    def test_revoke_then_contains(self):
+        token = auth.sign_token('u1', time.time() + 60, KEYS)
+        other = auth.sign_token('u2', time.time() + 60, KEYS)
+
+        revoked = auth.RevocationList(keys=KEYS)
+        self.assertNotIn(token, revoked)
+
+        revoked.revoke(token)
+        self.assertIn(token, revoked)
+        self.assertNotIn(other, revoked)
+
+    def test_ignores_invalid_tokens(self):
+        revoked = auth.RevocationList(keys=KEYS)
+        revoked.revoke('junk')
+        self.assertNotIn('junk', revoked)
+
+    def test_prunes_expired(self):
+        revoked = auth.RevocationList(keys=KEYS, prune_interval=0)
+        token = auth.sign_token('u1', time.time() + 60, KEYS)
+        revoked.tokens['v1.k2.u0.1.sig'] = 1
+
+        revoked.revoke(token)
+        self.assertIn(token, revoked)
+        self.assertNotIn('v1.k2.u0.1.sig', revoked)
+
+
+if __name__ == '__main__':
+    unittest.main()